@@ -0,0 +1,91 @@
+'''
+This builds the updates that keep the review aggregates of a business up to date. Each business
+stores 'review_count', 'star_sum' and 'avg_stars' alongside its reviews so the average can be read,
+sorted and indexed without loading the reviews array.
+
+The updates are aggregation pipelines so the reviews, the counters, the average and the version
+all change in the same atomic update. Review data is wrapped in $literal so text such as "$5 off"
+isn't read as a field path.
+'''
+
+#Imports the class used to define indexes
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+#Order of the top businesses, best average first then the most reviewed
+TOP_SORT = [("avg_stars", DESCENDING), ("review_count", DESCENDING)]
+
+#Indexes used by the top businesses query, with and without a town
+TOP_INDEXES = [
+    IndexModel([("town", ASCENDING)] + TOP_SORT, name = "town_top"),
+    IndexModel(TOP_SORT, name = "top")
+]
+
+#Stage that works out the average from the count and the sum, no reviews gives no average
+AVERAGE_STAGE = {"$set" : {"avg_stars" : {"$cond" : [
+    {"$gt" : ["$review_count", 0]}, {"$divide" : ["$star_sum", "$review_count"]}, None
+]}}}
+
+#Expression that increases a counter which might not exist yet
+def increase(field, amount):
+    return {"$add" : [{"$ifNull" : ["$" + field, 0]}, amount]}
+
+#Expression for the stars of the review with the given ID, 0 if there isn't one
+def stars_of(rid):
+    return {"$sum" : {"$map" : {
+        "input" : {"$filter" : {"input" : "$reviews", "cond" : {"$eq" : ["$$this._id", rid]}}},
+        "in" : "$$this.stars"
+    }}}
+
+#Update that adds reviews to a business, their stars must already be numbers
+def add_reviews_update(new_reviews):
+    return [
+        {"$set" : {
+            "reviews" : {"$concatArrays" : [{"$ifNull" : ["$reviews", []]}, {"$literal" : new_reviews}]},
+            "review_count" : increase("review_count", len(new_reviews)),
+            "star_sum" : increase("star_sum", sum(review["stars"] for review in new_reviews)),
+            "version" : increase("version", 1)
+        }},
+        AVERAGE_STAGE
+    ]
+
+#Update that changes the fields of one review, the filter must match the review ID
+def edit_review_update(rid, fields):
+    return [
+        {"$set" : {
+            "reviews" : {"$map" : {"input" : "$reviews", "in" : {"$cond" : [
+                {"$eq" : ["$$this._id", rid]}, {"$mergeObjects" : ["$$this", {"$literal" : fields}]}, "$$this"
+            ]}}},
+            "star_sum" : {"$add" : [{"$subtract" : [{"$ifNull" : ["$star_sum", 0]}, stars_of(rid)]}, fields["stars"]]},
+            "version" : increase("version", 1)
+        }},
+        AVERAGE_STAGE
+    ]
+
+#Update that removes one review, the filter must match the review ID
+def delete_review_update(rid):
+    return [
+        {"$set" : {
+            "reviews" : {"$filter" : {"input" : "$reviews", "cond" : {"$ne" : ["$$this._id", rid]}}},
+            "review_count" : increase("review_count", -1),
+            "star_sum" : {"$subtract" : [{"$ifNull" : ["$star_sum", 0]}, stars_of(rid)]},
+            "version" : increase("version", 1)
+        }},
+        AVERAGE_STAGE
+    ]
+
+#Update that converts ratings and stars stored as strings to numbers and works out the aggregates. The version is
+#increased so ETags given out for the old data no longer match
+BACKFILL_UPDATE = [
+    {"$set" : {
+        "rating" : {"$convert" : {"input" : "$rating", "to" : "int", "onError" : "$rating", "onNull" : None}},
+        "reviews" : {"$map" : {
+            "input" : {"$cond" : [{"$isArray" : "$reviews"}, "$reviews", []]}, #Reviews stored as {} become []
+            "in" : {"$mergeObjects" : ["$$this", {"stars" : {"$convert" : {
+                "input" : "$$this.stars", "to" : "int", "onError" : "$$this.stars", "onNull" : None
+            }}}]}
+        }},
+        "version" : increase("version", 1)
+    }},
+    {"$set" : {"review_count" : {"$size" : "$reviews"}, "star_sum" : {"$sum" : "$reviews.stars"}}},
+    AVERAGE_STAGE
+]
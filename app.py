@@ -1,78 +1,307 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, g, request, jsonify, make_response
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.local import LocalProxy
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
 from bson import ObjectId
+from cache import ResponseCache
+from aggregates import TOP_INDEXES, TOP_SORT, add_reviews_update, edit_review_update, delete_review_update
+from metrics import CommandTimer, PoolMonitor, RequestMetrics, Sampled, cache_metrics, server_timing, render
+from review_queue import ReviewQueue
+from common import (CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL, ROUTE_LABELS, LIST_INDEXES,
+                    STREAM_CHUNK_SIZE, stream_encoder, json_default, is_valid_objectid, normalize_id, to_score,
+                    has_fields, new_business_document, new_review_document, is_valid_batch, batch_status, batch_body_error,
+                    business_batch, review_batch, mark_failed_writes, business_url, review_url, get_projection,
+                    cache_view, is_current, VERSION_INDEX, VERSION_PROJECTION, get_list_options, check_ids, order_by_ids, get_top_options,
+                    get_review_page, plan_key, explain_command, QueryPlans, cursor_page_query, CursorPage)
+import config, itertools, os, pymongo, threading, time
+
+'''
+This provider lets jsonify handle the ObjectIds in businesses and reviews by writing them as
+strings with common.json_default, so documents from the database can be encoded as they are.
+Anything else is passed on to Flask's own encoding
+'''
+#JSON provider used by jsonify, so routes don't have to convert IDs themselves
+class MongoJSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(value):
+        try:
+            return json_default(value) #Encodes ObjectIds as strings
+        except TypeError: #Lets Flask encode any other types
+            return DefaultJSONProvider.default(value)
 
 app = Flask(__name__)
+app.json = MongoJSONProvider(app) #Uses the ObjectId aware provider for jsonify
+
+command_timer = CommandTimer() #Counts the database commands, documents and time of each request
+pool_monitor = PoolMonitor() #Counts the open and checked out connections of this process
+
+'''
+These functions create the database client the first time it is used in each process. A
+MongoClient isn't safe to use after a fork, so creating it lazily lets serve.py fork worker
+processes after the app is imported, and each worker gets its own connection pool. The pool size
+and timeouts come from config.py
+'''
+client, client_pid = None, None #Client of this process and the process it was made in
+client_lock = threading.Lock() #Stops two threads creating a client at once
+
+#Returns the client of this process, creating it if needed
+def get_client():
+    global client, client_pid
+    if client is None or client_pid != os.getpid(): #If there is no client yet or the process was forked
+        with client_lock:
+            if client is None or client_pid != os.getpid(): #Checks again now the lock is held
+                client = MongoClient(config.MONGO_URI, event_listeners = [command_timer, pool_monitor], **config.client_options())
+                client_pid = os.getpid()
+    return client
+
+#Returns the businesses collection on the client of this process
+def get_businesses():
+    return get_client()[config.MONGO_DB][config.MONGO_COLLECTION]
+
+businesses = LocalProxy(get_businesses) #Selects the collection when it is used
+
+query_plans = QueryPlans() #Whether each query shape can be run, so each shape is only explained once
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_MAX_BYTES) #Cache of serialized business and review responses
+
+#Metrics published at /metrics
+request_metrics = RequestMetrics(ROUTE_LABELS) #Time and database work of requests, labelled by route and method
+METRICS = request_metrics.metrics + cache_metrics(response_cache) + [
+    Sampled("mongo_pool_connections", "Open database connections in this process", "gauge", lambda: pool_monitor.open),
+    Sampled("mongo_pool_connections_in_use", "Database connections checked out by requests", "gauge", lambda: pool_monitor.in_use)
+]
+
+#Queue that writes new reviews in batches, only used when REVIEW_WRITE_BEHIND is set
+review_queue = None
+if config.REVIEW_WRITE_BEHIND:
+    review_queue = ReviewQueue(lambda: businesses, config.REVIEW_QUEUE_MAX, config.REVIEW_FLUSH_INTERVAL,
+                               on_written = response_cache.invalidate, #Removes each written business from the cache
+                               max_attempts = config.REVIEW_FLUSH_ATTEMPTS)
+    METRICS.extend(review_queue.metrics)
+
+'''
+These functions time every request. Before the request the timer is started and the database
+totals are reset. Afterwards the time and database work so far are sent to the client in a
+Server-Timing header, and once the body has been sent the request is added to the metrics for
+the route, so the time and database work of a streamed body are counted too. stream_json reads
+its first chunk before the headers are sent, so for a normal page every query has already run
+when the header is written
+'''
+#Starts timing the request
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter() #Notes when the request started
+    command_timer.reset() #Starts new database totals for this request
+
+#Sends the timings so far and records the request once its body has been sent
+@app.after_request
+def record_timing(response):
+    start = g.start
+    seconds = time.perf_counter() - start #Time taken to handle the request
+    totals = command_timer.totals() #Database work done by the request, a streamed body adds to it as it is sent
+    labels = (request.url_rule.rule if request.url_rule else "unmatched", request.method)
+
+    response.headers["Server-Timing"] = server_timing(totals, seconds) #Adds the timings to the response
+
+    #Records the metrics when the server closes the response, after the last chunk is sent
+    response.call_on_close(lambda: request_metrics.record(labels, response.status_code, time.perf_counter() - start, totals))
+    return response
+
+'''
+This function streams a list of documents as a JSON array. Each document is encoded as it comes
+from the database cursor and the output is sent in chunks, so the whole list is never held in
+memory and the first chunk doesn't wait for the last document. Text can be added before and
+after the array, 'after' is a function so it can use values found while the documents are read.
+The first chunk is read straight away, so the query runs while the request is being handled and a
+database error gives a normal error response instead of a broken stream
+'''
+#Streams documents from a cursor as a JSON response
+def stream_json(documents, status = 200, before = "", after = None):
+    def generate():
+        buffer = [before + "["] #Starts the array
+        buffered = len(buffer[0]) #Number of characters waiting to be sent
+        for count, document in enumerate(documents): #Encodes each document as it arrives
+            encoded = stream_encoder.encode(document)
+            buffer.append("," + encoded if count else encoded) #Separates documents with commas
+            buffered += len(encoded) + 1
+            if buffered >= STREAM_CHUNK_SIZE: #Sends the buffer once it is big enough
+                yield "".join(buffer)
+                buffer, buffered = [], 0
+        buffer.append("]" + (after() if after else "")) #Ends the array
+        yield "".join(buffer) #Sends whatever is left
+    chunks = generate()
+    first = next(chunks) #Runs the query and reads the first chunk
+    return Response(itertools.chain([first], chunks), status = status, mimetype = "application/json")
+
+'''
+This function reads a rating or star score from the form data as a number, so scores can be
+summed and sorted by the database. None is returned if the score isn't a whole number from 1 to 5
+'''
+#Reads a score from 1 to 5 from the form data
+def get_score(name):
+    return to_score(request.form[name])
+
+#Reads the list of items in a batch request, or None if the body isn't a list of the right size
+def get_batch_items():
+    items = request.get_json(silent = True) #Reads the JSON body, None if it isn't JSON
+    return items if is_valid_batch(items) else None
+
+#Returns the results of a batch, 201 if every item was added, 207 if some were and 400 if none were
+def batch_response(results):
+    return make_response(jsonify ({"results" : results}), batch_status(results))
 
-client = MongoClient("mongodb://127.0.0.1:27017")
-db = client.dizDB #Selects the database
-businesses = db.biz #Selects the collection
+'''
+This function returns a cached JSON response for one view of a business. If the view isn't
+cached, 'load' is called to query the database. It returns the document's version and the data,
+or an error response which isn't cached. The ETag is made from the business ID, its version and
+the view, so it changes whenever the business does. If the client already has that ETag a 304
+is returned. Another worker may have changed the business since the view was cached, so when
+CACHE_REVALIDATE is set a cached view is only used if the business still has the same version,
+which is read from the id_version index alone rather than loading and serializing the view again
+'''
+#Returns a view of a business from the cache, loading it on a miss
+def cached_json(id, view, load):
+    cached = response_cache.get(id, view) #Looks for the view in the cache
+    if cached is not None and config.CACHE_REVALIDATE: #Checks another worker hasn't changed the business
+        if not is_current(cached, id, view, read_version(id)):
+            response_cache.invalidate(id) #Removes the old views of the business
+            cached = None
+    if cached is None: #If the view isn't cached
+        epoch = response_cache.epoch #Notes the epoch so a load that races a write isn't stored
+        loaded = load() #Queries the database
+        if isinstance(loaded, Response): #If the load returned an error response
+            return loaded
+        version, data = loaded
+        cached = cache_view(response_cache, id, view, version, data, epoch) #Serializes and stores the response
+
+    #Returns a 304 if the client already has this version
+    etag, body = cached
+    if request.if_none_match.contains(etag):
+        response = Response(status = 304)
+    else:
+        response = Response(body, status = 200, mimetype = "application/json")
+    response.set_etag(etag) #Adds the strong ETag to the response
+    return response
+
+#Reads the ID and version of a business from the id_version index, None if it doesn't exist
+def read_version(id):
+    try:
+        return next(businesses.find({"_id" : ObjectId(id)}, VERSION_PROJECTION).hint(VERSION_INDEX.document["name"]).limit(1), None)
+    except OperationFailure: #If the index hasn't been created, the version is read from the document
+        return businesses.find_one({"_id" : ObjectId(id)}, VERSION_PROJECTION)
+
+'''
+This function finds businesses while making sure the query can use an index. The first time a
+query shape is seen its plan is checked with explain(). If the plan scans the whole collection, or
+a whole index for a filtered query, it is logged, and the query is rejected when
+REJECT_COLLECTION_SCANS is set in config.py
+'''
+#Finds businesses, returns None if the query would read every document and is rejected
+def find_businesses(query, projection, sort_order):
+    cursor = businesses.find(query, projection).sort(sort_order)
+    shape = plan_key(query, sort_order)
+    allowed = query_plans.allows(shape)
+    if allowed is None: #If this shape hasn't been checked yet, asks the database how it would run the query
+        explained = businesses.database.command(explain_command(businesses.name, query, projection, sort_order))
+        allowed = query_plans.check(shape, explained["queryPlanner"]["winningPlan"], query)
+    return cursor if allowed else None
 
 '''
 This function handles GET requests to fetch all business with pagination. It sets values for
 page number and size then checks for these parameters in the query then calculates the 
 starting index for the query and retreives the businesses from the database. The results
-are returned as a  JSON response
+are returned as a  JSON response. If the 'after' parameter is given, cursor pagination is used
+instead so deep pages don't have to skip over every earlier business. Only a summary of each
+business is returned unless other fields are asked for with 'fields'. The businesses can be
+filtered by town, rating and name and ordered with 'sort', all done by the database
 '''
 #Gets all businesses with pagination
 @app.route("/api/v1.0/businesses", methods = ["GET"]) #Route to businesses, uses GET method get all businesses
 def show_all_businesses(): #Defines function to show all businesses
-    #Values for pagination
-    page_num, page_size = 1, 10 #Sets the page numbber to 1 and page size to 10
-    
-    #Checks if 'pn' (page number) is provided in the query paramenters
-    if request.args.get('pn'): #Retreives the 'pn' paramter if it exists
-        page_num = int(request.args.get('pn')) #Converts page number to an integer
-    
-    #Checks if 'ps' (page size) is provided in the query paramenters   
-    if request.args.get('ps'): #Retreives the 'ps' paramter if it exists
-        page_num = int(request.args.get('ps')) #Convvers the page number to an integer
+    #Reads the page, projection, filter and sort order from the query parameters
+    error, options = get_list_options(request.args)
+    if error: #If a parameter isn't valid
+        return make_response( jsonify ({"error" : error}), 400)
+    page_size, projection = options["page_size"], options["projection"]
 
-    #Calculates the start index of the page    
-    page_start = (page_size * (page_num - 1)) #Calculates based on current page number and size
+    #Gets the listed businesses if 'ids' is provided
+    if options["ids"]:
+        return show_businesses_by_ids(options["ids"], projection)
+
+    #Uses cursor pagination if 'after' is provided, an empty 'after' starts from the first page
+    if options["after"] is not None:
+        return show_businesses_after(options["after"], page_size, projection,
+                                     options["query"], options["sort"], options["sort_order"])
 
-    #Empty list to store the results
-    data_to_return = [] #Assigs an empty list to 'data_to_return'
+    #Calculates the start index of the page    
+    page_start = (page_size * (options["page_num"] - 1)) #Calculates based on current page number and size
 
     #Queries the databse to get the businesses with pagination
-    for business in businesses.find() \
-                    .skip(page_start) \
-                    .limit(page_size): #Skips to the start of the current page / Limits the results to the page size
-        business['_id'] = str(business['_id']) #Converts business ID to string
-
-        for review in business['reviews']: #Iterates over each review in the business
-            review['_id'] = str(review['_id']) #Converts review ID to string        
-        data_to_return.append(business) #Adds the business to the results list 'data_to_return'
+    cursor = find_businesses(options["query"], projection, options["sort_order"])
+    if cursor is None: #If the query would scan the whole collection
+        return make_response( jsonify ({"error" : "This combination of filters and sort isn't supported"}), 400)
+    cursor = cursor.skip(page_start) \
+                   .limit(page_size) #Skips to the start of the current page / Limits the results to the page size
     
-    #Returns the results as a JSON response with a 200 status code
-    return make_response( jsonify(data_to_return), 200) #Converts the results list to JSON
+    #Streams the results as a JSON response with a 200 status code
+    return stream_json(cursor) #Encodes each business as it is read from the cursor
 
 '''
-This function validates the ID by ensuring it's a 24 character hexadecimal string. It checks
-if the length of the ID is exactly 24. If not, it returns Flase. Then, it iterates through
-each character in the ID to check if it's a valid hexadecimal character. If any character 
-isn't a valid hexadecimal digit, it returns False. If all checks pass, it returns True which
-indicates that the ID is valid
+This function returns the businesses with the given IDs using a single $in query instead of one
+query for each business. The businesses are returned in the order the IDs were given, with null
+for any ID that doesn't match a business
 '''
-#Validation for ObjectID    
-def is_valid_objectid(id):
-    #Checks if the ID length is 24
-    if len(id) != 24: #If ID length is equal to 24
-        return False #Returns False if the length is not 24
+#Gets businesses by their IDs
+def show_businesses_by_ids(ids, projection):
+    #Checks the number of IDs and that each one is valid
+    error = check_ids(ids)
+    if error:
+        return make_response( jsonify ({"error" : error}), 400)
+
+    #Queries the database for every business at once
+    found = businesses.find({"_id" : {"$in" : [ObjectId(id) for id in ids]}}, projection)
+
+    #Returns the businesses in the order of the IDs with a 200 status code
+    return make_response( jsonify (order_by_ids(ids, found)), 200)
+
+'''
+This function returns one page of businesses using cursor (keyset) pagination. Rather than
+skipping over earlier businesses, it seeks straight past the last business of the previous page
+using the sort field and '_id', which can be answered from an index. One extra business is
+fetched to tell if there is another page, and if so a 'next' token is returned with the results
+'''
+#Gets a page of businesses after a cursor token
+def show_businesses_after(token, page_size, projection, query, sort, sort_order):
+    #Adds to the query a filter that seeks past the last business of the previous page
+    page_query = cursor_page_query(query, projection, token, sort)
+    if page_query is None: #If the token isn't valid
+        return make_response( jsonify ({"error" : "Invalid cursor"}), 400)
+
+    #Queries the database for one more business than the page size
+    cursor = find_businesses(*page_query, sort_order)
+    if cursor is None: #If the query would scan the whole collection
+        return make_response( jsonify ({"error" : "This combination of filters and sort isn't supported"}), 400)
+    cursor = cursor.limit(page_size + 1)
+
+    #Passes on the businesses for the page, the page creates the next token if the extra one is returned
+    page = CursorPage(page_size, sort)
+    def page_businesses():
+        for business in cursor:
+            if not page.add(business):
+                break
+            yield business
+
+    #Streams the page and the token for the next page with a 200 status code
+    return stream_json(page_businesses(), before = page.before, after = page.after)
 
-    #Checks if all characters are hexadecimal
-    hex_digits =  "0123456789abcdefABCDEF" #String of hexadecimal characters
-    
-    for char in id: #Iterates over each character in the ID
-        if char not in hex_digits: #Checks if the character is not in the 'hex_digits' list
-            return False #Returns False if any character is not a hexadecimal
-    return True #Returns True if the ID is valid
 
 '''
 This function handles GET requests to retrieve a specific business by its ID. It will 
 validate the provided business ID ensure it's a valid 24 character hexadecimal string. If the
 ID is valid, it queries the 'businesses' collection in the database to find the business 
-with the given ID. If the business is not found or the ID is invalid, it returns an error message
+with the given ID. If the business is not found or the ID is invalid, it returns an error message.
+Every field is returned unless only some are asked for with 'fields'. Responses are cached until
+the business is changed
 '''
 
 #Gets one business
@@ -81,18 +310,44 @@ def show_one_businesses(id): #Defines function to show one business which takes
     #Checks if the provided business ID is valid
     if not is_valid_objectid(id): #Validates the business ID
         return make_response(jsonify ({"error": "Invalid business ID"}), 400 ) #Returns error message if ID is invalid with 404 status code
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
+
+    #Builds the projection, every field is returned by default
+    projection = get_projection(request.args, []) #An empty projection returns every field
+    if projection is None: #If an unknown field was asked for
+        return make_response(jsonify ({"error": "Invalid fields"}), 400)
 
     #Queries the database to find the business with the given ID
-    business = businesses.find_one( {'_id' : ObjectId(id)} ) #Retrieves the business from the database
-    
-    if business is not None: #Checks if the business exists
-        business['_id'] = str(business['_id']) #Converts business ObjectId to string
-        for review in business['reviews']: #Goes over each review in the business
-            review['_id'] = str(review['_id']) #Converts review ObjectId to string
-        return make_response( jsonify (business), 200) #Returns the business data as JSON with a 200 status code
-    else: #If business doesn't exists
-        return make_response( jsonify ({"error" : "Invalid business ID"}), 404) #Returns an error message with a 404 status code 
+    def load():
+        if projection: #Includes the version when only some fields are returned
+            projection["version"] = 1
+        business = businesses.find_one( {'_id' : ObjectId(id)}, projection or None ) #Retrieves the business from the database
+        
+        if business is not None: #Checks if the business exists
+            return business.pop("version", 0), business #Returns the version and the business data
+        else: #If business doesn't exists
+            return make_response( jsonify ({"error" : "Invalid business ID"}), 404) #Returns an error message with a 404 status code 
 
+    #Returns the business data as JSON with a 200 status code, from the cache if possible
+    return cached_json(id, "business?fields=" + request.args.get('fields', ""), load)
+
+
+'''
+This function handles GET requests for the best rated businesses, optionally in one town. They
+are ordered by their stored average stars then their number of reviews, which is answered from
+the 'town_top' or 'top' index so no reviews are read. 'n' sets how many are returned
+'''
+#Gets the top businesses
+@app.route("/api/v1.0/businesses/top", methods = ["GET"])
+def show_top_businesses():
+    #Reads the number of businesses from 'n' and the town from 'town'
+    error, options = get_top_options(request.args)
+    if error:
+        return make_response( jsonify ({"error" : error}), 400)
+
+    #Queries the database for the top businesses and streams them with a 200 status code
+    cursor = businesses.find(options["query"], options["projection"]).sort(TOP_SORT).limit(options["count"])
+    return stream_json(cursor) #Returns the summary of each business
 
 #Adds a new business
 @app.route("/api/v1.0/businesses", methods = ["POST"]) #Route to businesses, uses POST method to add new business
@@ -101,41 +356,99 @@ def add_businesses(): #Defines function to add business
     if  "name" in request.form and \
         "town" in request.form and \
         "rating" in request.form:
+
+        #Checks the rating is a number from 1 to 5
+        rating = get_score("rating")
+        if rating is None:
+            return make_response( jsonify ({"error" : "Rating must be a whole number from 1 to 5"}), 400)
         
         #Creates a new business with the form data provided
-        new_business = {
-            "name" : request.form["name"], #Assigns 'name' from form data
-            "town" : request.form["town"], #Assigns 'town' from form data
-            "rating" : request.form["rating"], #Assigns 'rating' from form data
-            "reviews" : {} #Initializes 'reviews' as an empty dictionary
-        }
+        new_business = new_business_document(request.form["name"], request.form["town"], rating)
         
         #Inserts the new business into the 'businesses' collection
         new_business_id = businesses.insert_one(new_business) #Adds thew new business and assigns it to 'new_business_id'
         #Creates a link to the newly added business
-        new_business_link = "http://127.0.0.1:2000/api/v1.0/businesses/" \
-                            + str(new_business_id.inserted_id) #Adds the URL with the new business ID
+        new_business_link = business_url(new_business_id.inserted_id) #Adds the URL with the new business ID
 
         return make_response( jsonify ({"url" : new_business_link}), 201 ) #Returns the new business URL with a 201 status
     else:
         return make_response( jsonify ({"error" : "Missing form data"}), 404) #Returns an error message if a form data is missing with a 404 status
 
+'''
+This function handles POST requests that add many businesses at once. The body is a JSON list of
+businesses with a name, town and rating. The valid ones are inserted with one unordered
+bulk_write, and a result is returned for each item in the order they were given, with a URL for
+the businesses that were added and an error for the ones that weren't
+'''
+#Adds a batch of businesses
+@app.route("/api/v1.0/businesses:batch", methods = ["POST"])
+def add_businesses_batch():
+    items = get_batch_items() #Reads the list of businesses
+    if items is None:
+        return make_response( jsonify ({"error" : batch_body_error("businesses")}), 400)
+
+    #Checks each business and creates the inserts for the valid ones
+    results, operations, positions = business_batch(items)
+
+    #Inserts every valid business in one round trip, a failed insert doesn't stop the others
+    if operations:
+        try:
+            businesses.bulk_write(operations, ordered = False)
+        except BulkWriteError as error:
+            mark_failed_writes(results, positions, error.details) #Marks the businesses that failed
+
+    return batch_response(results)
+
+'''
+This function handles POST requests that add many reviews to a business at once. The body is a
+JSON list of reviews with a username, comment and stars. The valid ones are added in a single
+update along with the review aggregates, and a result is returned for each item
+'''
+#Adds a batch of reviews to a business
+@app.route("/api/v1.0/businesses/<string:id>/reviews:batch", methods = ["POST"])
+def add_reviews_batch(id):
+    if not is_valid_objectid(id): #Checks if business ID is valid
+        return make_response( jsonify ({"error" : "Invalid business ID"}), 400)
+    id = normalize_id(id) #Uses the lowercase ID so the right cache entry is invalidated
+    items = get_batch_items() #Reads the list of reviews
+    if items is None:
+        return make_response( jsonify ({"error" : batch_body_error("reviews")}), 400)
+
+    #Checks each review and creates the valid ones
+    results, new_reviews = review_batch(id, items)
+
+    #Adds every valid review in one update
+    if new_reviews:
+        result = businesses.update_one( {"_id" : ObjectId(id)}, add_reviews_update(new_reviews) )
+        response_cache.invalidate(id) #Removes the business from the cache
+        if result.matched_count == 0: #If the business does not exist
+            return make_response( jsonify ({"error" : "Business not found"}), 404)
+
+    return batch_response(results)
+
 #Edits a business
 @app.route("/api/v1.0/businesses/<string:id>", methods = ["PUT"]) #Root route, for PUT method
 def edit_businesses(id): #Defines function, takes id as input
+    if not is_valid_objectid(id): #Checks if business ID is valid
+        return make_response( jsonify ({"error" : "Invalid business ID"}), 400)
+    id = normalize_id(id) #Uses the lowercase ID so the right cache entry is invalidated
     if  "name" in request.form and \
         "town" in request.form and \
         "rating" in request.form:
+        rating = get_score("rating") #Reads the rating as a number
+        if rating is None:
+            return make_response( jsonify ({"error" : "Rating must be a whole number from 1 to 5"}), 400)
         result = businesses.update_one(
             {"_id" : ObjectId(id)},
             {"$set" : {
                 "name" : request.form["name"],
                 "town" : request.form["town"],
-                "rating" : request.form["rating"]
-            }}
+                "rating" : rating
+            }, "$inc" : {"version" : 1}} #Increases the version so the ETag changes
         )
+        response_cache.invalidate(id) #Removes the business from the cache
         if  result.matched_count == 1:
-            edited_business_link = "http://127.0.0.1:2000/api/v1.0/businesses/" + id
+            edited_business_link = business_url(id)
             return make_response( jsonify ({"url" : edited_business_link}), 200) #Output,      
         else:
             return make_response( jsonify ({"error" : "Invalid business ID"}), 404) #Output, returns error message with 404 status
@@ -145,7 +458,11 @@ def edit_businesses(id): #Defines function, takes id as input
 #Deletes a business
 @app.route("/api/v1.0/businesses/<string:id>", methods = ["DELETE"]) #Root route, for DELETE method
 def delete_businesses(id): #Defines function, takes id as input
+    if not is_valid_objectid(id): #Checks if business ID is valid
+        return make_response( jsonify ({"error" : "Invalid business ID"}), 400)
+    id = normalize_id(id) #Uses the lowercase ID so the right cache entry is invalidated
     result = businesses.delete_one( {"_id" : ObjectId(id)} )
+    response_cache.invalidate(id) #Removes the business from the cache
     if result.deleted_count == 1:
         return make_response( jsonify ({}), 204)
     else:
@@ -157,62 +474,79 @@ def add_new_review(id): #Defines function to add a new review, takes id as its p
     #Validates the business ID
     if not is_valid_objectid(id): #Checks if business ID is valid
         return make_response(jsonify ({"error": "Invalid business ID"}), 400) #Returns a error message if ID is invalid with 400 status code
+    id = normalize_id(id) #Uses the lowercase ID so the right cache entry is invalidated
     
-    #Checks if the business exists
-    business = businesses.find_one({'_id' : ObjectId(id)}) #Queries the databse to find the business by ID
-    if not business: #If the business does not exist
-        return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
-
     #Validates if there are form data to update
     if not ("username" in request.form and \
            "comment" in request.form and \
            "stars" in request.form): 
         return make_response(jsonify ({"error": "Missing form data"}), 400) #Returns a error message if any form data is missing with 400 status code
 
+    #Checks the stars are a number from 1 to 5
+    stars = get_score("stars")
+    if stars is None:
+        return make_response(jsonify ({"error": "Stars must be a whole number from 1 to 5"}), 400)
+
     #Creates a new review dictionary with the provided form data
-    new_review = {
-        "_id" : ObjectId(), #Generates a new ObjectId for the review
-        "username" : request.form["username"], #Assigns the 'username' from the form data
-        "comment" : request.form["comment"], #Assigns the 'comment' from the form data
-        "stars" : request.form["stars"] #Assigns the 'stars' from the form data
-    }
-
-    #Updates the business document by pushing the new review into the 'reviews' array
-    businesses.update_one( {"_id" : ObjectId(id)}, {"$push": {"reviews" : new_review}} ) #Adds the 
-
-    #Creates a link to the newly added review
-    new_review_link =  "http://127.0.0.1:2000/api/v1.0/businesses/" \
-                        + id +"/reviews/" + str(new_review['_id']) #Constructs the URL for the new review by combining the base URL, business ID, and review ID
-    
+    new_review = new_review_document(request.form["username"], request.form["comment"], stars)
+    new_review_link = review_url(id, new_review['_id']) #Constructs the URL for the new review from the business ID and review ID
+
+    #Queues the review to be written with the others for this business if write-behind is on
+    if review_queue is not None:
+        #Checks the business exists first, a lookup of the _id index alone, so a 202 means the review will be written
+        if businesses.find_one({"_id" : ObjectId(id)}, {"_id" : 1}) is None:
+            return make_response(jsonify ({"error" : "Business not found"}), 400)
+        if not review_queue.add(id, new_review): #If the queue is full
+            response = make_response(jsonify ({"error" : "Too many reviews waiting, try again later"}), 503)
+            response.headers["Retry-After"] = "1"
+            return response
+        return make_response(jsonify ({ "url" : new_review_link }), 202) #Accepted, the review is written within the flush interval
+
+    #Updates the business document by adding the new review to the 'reviews' array and updating the review aggregates
+    result = businesses.update_one( {"_id" : ObjectId(id)}, add_reviews_update([new_review]) ) #Adds the review and increases the version
+    response_cache.invalidate(id) #Removes the business from the cache
+
+    #Checks if the business exists, from the update so no separate query is needed
+    if result.matched_count == 0: #If the business does not exist
+        return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
+
     #Returns the URL of the new review with a 201 status code
     return make_response(jsonify ({ "url" : new_review_link }), 201) #Sends a response with the new review URL and a status code of 201
 
 
+'''
+This function handles GET requests to fetch a page of reviews for a business. The page is taken
+from the reviews array by the database with $slice, using the 'offset' and 'limit' query
+parameters, so the whole array is never loaded just to return part of it. Pages are cached
+until the business is changed
+'''
 #Gets all reviews for a specific business
 @app.route("/api/v1.0/businesses/<string:id>/reviews", methods=["GET"]) #Route for fetching all reviews for a specific business using GET method
 def fetch_all_reviews(id): #Defines function to fetch all review of a specified business, takes id as its parameter
     #Validates the business ID
     if not is_valid_objectid(id): #Checks if business ID is valid
         return make_response(jsonify ({"error": "Invalid business ID"}), 400) #Returns a error message if ID is invalid with 400 status code
-    
-    #Checks if the business exists
-    business = businesses.find_one({'_id' : ObjectId(id)}) #Queries the databse to find the business by ID
-    if not business: #If the business does not exist
-        return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
 
-    #Initialise a list    
-    data_to_return = [] #Empty list assigned to 'data_to_return'
-    
-    #Retrieves the reviews of a specific business by its ObjectId
-    business = businesses.find_one(
-        {"_id" : ObjectId(id)}, \
-        {"reviews" : 1, "_id" : 0 }) #Finds the business by its ObjectId and only retrieve its reviews
+    #Values for paging through the reviews, 'offset' reviews are skipped and 'limit' are returned
+    error, page = get_review_page(request.args)
+    if error: #If 'offset' or 'limit' isn't valid
+        return make_response(jsonify ({"error": error}), 400)
+    offset, limit = page
+
+    #Retrieves the page of reviews of a specific business by its ObjectId
+    def load():
+        business = businesses.find_one(
+            {"_id" : ObjectId(id)}, \
+            {"version" : 1, "reviews" : {"$slice" : [offset, limit]}}) #Finds the business by its ObjectId and only retrieve the page of reviews
 
-    #For loop, loops through and proccesses each review    
-    for review in business["reviews"]: #Goes through each review in the business reviews
-        review["_id"] = str(review["_id"]) #Coverts the ID of each review into a string
-        data_to_return.append(review) #Adds the review to the list of data to return
-    return make_response(jsonify (data_to_return), 200 ) #Returns the list of reviews as a JSON response with a 200 status code 
+        #Checks if the business exists
+        if not business: #If the business does not exist
+            return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
+        return business.get("version", 0), business.get("reviews", []) #Returns the version and the page of reviews
+
+    #Returns the page of reviews as a JSON response with a 200 status code, from the cache if possible
+    return cached_json(id, "reviews?offset=" + str(offset) + "&limit=" + str(limit), load)
 
 #Gets one review
 @app.route("/api/v1.0/businesses/<bid>/reviews/<rid>", methods=["GET"])
@@ -222,22 +556,22 @@ def fetch_one_review(bid, rid): #Defines function to fetch one review, takes bid
     if not is_valid_objectid(bid) or not is_valid_objectid(rid): #Checks if either ID is invalid
         error_message = "Bad business ID" if not is_valid_objectid(bid) else "Bad review ID" # Sets a error message based on which ID is invalid
         return make_response(jsonify ({"error" : error_message}), 400) #Returns the error message if either ID is invalid with 400 status code
+    bid, rid = normalize_id(bid), normalize_id(rid) #Uses the lowercase IDs so every form of them shares one cache entry
     
     # Queries the database to find the business by ID and its review by review ID
-    business = businesses.find_one(  #Queries the database to find the business with the given ID and the review with the given ID
-    {"_id": ObjectId(id), "reviews._id": ObjectId(rid)},  #Matches both the business ID and the review ID
-    {"_id": 0, "reviews.$": 1}  #Shows only the matched review
-    ) 
-
-    #Checks if the business and review exists
-    if not business: #If the review doesn't exist within the business
-        return make_response(jsonify ({"error" : "Review not found"}), 404) #Returns an error message with 404 status code
-    
-    #Converts the review ObjectId to a string
-    business['reviews'][0]['_id'] = str(business['reviews'][0]['_id'])
-    
-    #Returns the review datya as JSON and with a 200 status code
-    return make_response(jsonify (business['reviews'][0]), 200) #Sends the review data 
+    def load():
+        business = businesses.find_one(  #Queries the database to find the business with the given ID and the review with the given ID
+        {"_id": ObjectId(bid), "reviews._id": ObjectId(rid)},  #Matches both the business ID and the review ID
+        {"_id": 0, "reviews.$": 1, "version": 1}  #Shows only the matched review and the version
+        ) 
+
+        #Checks if the business and review exists
+        if not business: #If the review doesn't exist within the business
+            return make_response(jsonify ({"error" : "Review not found"}), 404) #Returns an error message with 404 status code
+        return business.get("version", 0), business['reviews'][0] #Returns the version and the review
+
+    #Returns the review datya as JSON and with a 200 status code, from the cache if possible
+    return cached_json(bid, "review/" + rid, load) #Sends the review data 
 
 #Edits a review
 @app.route("/api/v1.0/businesses/<bid>/reviews/<rid>", methods=["PUT"])
@@ -247,45 +581,99 @@ def edit_review(bid, rid):
     if not is_valid_objectid(bid) or not is_valid_objectid(rid):
         error_message = "Invalid business ID" if not is_valid_objectid(bid) else "Invalid review ID"
         return make_response(jsonify({"error": error_message}), 400)
+    bid, rid = normalize_id(bid), normalize_id(rid) #Uses the lowercase IDs so the right cache entry is invalidated
     
-     # Find business and the specific review in one query
-    business = businesses.find_one(
-        {"_id": ObjectId(bid), "reviews._id": ObjectId(rid)},
-        {"_id": 0, "reviews.$": 1}  # Only return the matching review
-    )
+    if not has_fields(request.form, ("username", "comment", "stars")): #Checks every field is given
+        return make_response(jsonify({"error": "Missing form data"}), 400)
+    stars = get_score("stars")  # Read the stars as a number
+    if stars is None:
+        return make_response(jsonify({"error": "Stars must be a whole number from 1 to 5"}), 400)
 
-    # Check if business and review exist
-    if not business:
-        return make_response(jsonify({"error": "Review not found"}), 404)
-    
     edited_review = {
-        "reviews.$.username" : request.form["username"],
-        "reviews.$.comment" : request.form["comment"],
-        "reviews.$.stars" : request.form['stars']
+        "username" : request.form["username"],
+        "comment" : request.form["comment"],
+        "stars" : stars
         }
 
+    # Update the review, the star sum, the average and the version in one update
     result = businesses.update_one(
         {"_id": ObjectId(bid), "reviews._id": ObjectId(rid)},
-        {"$set": edited_review}
+        edit_review_update(ObjectId(rid), edited_review)
     )
+    response_cache.invalidate(bid)  # Remove the business from the cache
 
     # Check if the update matched a document (i.e., business and review exist)
     if result.matched_count == 0:
-        return make_response(jsonify({"error": "Review not found or no changes made"}), 404)
+        return make_response(jsonify({"error": "Review not found"}), 404)
 
-    edit_review_url = f"http://localhost:5000/api/v1.0/businesses/{bid}/reviews/{rid}"
+    edit_review_url = review_url(bid, rid)
     
     return make_response(jsonify ({"url":edit_review_url}), 200)
 
 #Deletes a review
-@app.route("/api/v1.0/businesses/<bid>/reviews/<id>", methods=["DELETE"])
+@app.route("/api/v1.0/businesses/<bid>/reviews/<rid>", methods=["DELETE"])
 def delete_review(bid, rid): 
-    businesses.update_one(
-        {"_id" : ObjectId(bid)},
-        { "$pull" : { "reviews" : { "_id" : ObjectId(rid) } } }
+    if not is_valid_objectid(bid) or not is_valid_objectid(rid):
+        error_message = "Invalid business ID" if not is_valid_objectid(bid) else "Invalid review ID"
+        return make_response(jsonify({"error": error_message}), 400)
+    bid, rid = normalize_id(bid), normalize_id(rid) #Uses the lowercase IDs so the right cache entry is invalidated
+
+    #Removes the review and updates the review aggregates, only if the review exists
+    result = businesses.update_one(
+        {"_id" : ObjectId(bid), "reviews._id" : ObjectId(rid)},
+        delete_review_update(ObjectId(rid))
         )
-    
+    response_cache.invalidate(bid) #Removes the business from the cache
+
+    if result.matched_count == 0: #If the business or review doesn't exist
+        return make_response(jsonify ({"error" : "Review not found"}), 404)
     return make_response(jsonify ({}), 204)
 
+#Gets the cache counters, used to size the cache
+@app.route("/api/v1.0/cache", methods=["GET"])
+def show_cache_stats():
+    return make_response(jsonify (response_cache.stats()), 200)
+
+'''
+This function creates the indexes used by the API. Creating an index that already exists does
+nothing, so it is safe to run every time the app starts
+'''
+#Creates the indexes for the businesses collection
+def ensure_indexes():
+    businesses.create_indexes(LIST_INDEXES) #Indexes for the list filters and sort orders
+    businesses.create_indexes(TOP_INDEXES) #Indexes for the top businesses query
+    businesses.create_indexes([VERSION_INDEX]) #Index the version of a cached view is checked with
+
+'''
+These functions are the health checks used by a load balancer or process manager. '/healthz'
+only shows the process is answering. '/readyz' checks out a connection from the pool and pings
+the database within HEALTH_CHECK_TIMEOUT_MS, and returns 503 if that fails or if the worker is
+draining before it stops, so no new requests are sent to it
+'''
+#Checks the process is running
+@app.route("/healthz", methods=["GET"])
+def show_health():
+    return make_response(jsonify ({"status" : "ok", "pid" : os.getpid()}), 200)
+
+#Checks the process can reach the database and is taking requests
+@app.route("/readyz", methods=["GET"])
+def show_readiness():
+    pool = {"open" : pool_monitor.open, "in_use" : pool_monitor.in_use, "max" : config.MONGO_MAX_POOL_SIZE}
+    if app.config.get("DRAINING"): #If serve.py is stopping this worker
+        return make_response(jsonify ({"status" : "draining", "pid" : os.getpid(), "pool" : pool}), 503)
+    try:
+        with pymongo.timeout(config.HEALTH_CHECK_TIMEOUT_MS / 1000): #Fails if no connection is free in time
+            get_client().admin.command("ping")
+    except PyMongoError as error:
+        return make_response(jsonify ({"status" : "unavailable", "pid" : os.getpid(), "pool" : pool, "error" : str(error)}), 503)
+    return make_response(jsonify ({"status" : "ready", "pid" : os.getpid(), "pool" : pool}), 200)
+
+#Gets the metrics in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def show_metrics():
+    return Response(render(METRICS), mimetype = "text/plain; version=0.0.4")
+
+#Runs the development server, use serve.py to run the app with several worker processes
 if __name__ == "__main__":
+    ensure_indexes() #Makes sure the indexes exist before serving requests
     app.run(debug = True, port = 2000)
\ No newline at end of file
@@ -0,0 +1,594 @@
+'''
+This is an asyncio version of the API in app.py, served as an ASGI app on pymongo's
+AsyncMongoClient. It has the same /api/v1.0/businesses routes, parameters and responses, the
+same /metrics and the /healthz and /readyz checks, and shares its validation, query building and serialization with app.py through
+common.py, so only the request handling differs.
+
+The Flask app holds a thread for every request while it waits on the database. Here a request
+waiting on the database is just a paused task, so one process can keep thousands of requests in
+flight. Two settings in config.py limit it: MONGO_MAX_POOL_SIZE caps the connections to the
+database, and ASYNC_MAX_CONCURRENCY caps the requests handled at once, the rest wait their turn.
+
+Routes are matched with regular expressions so no web framework is needed, only an ASGI server.
+Form data must be URL encoded, multipart forms aren't read.
+
+Usage: uvicorn async_app:app --port 2001 [--workers N]
+       with more than one worker set CACHE_REVALIDATE=1, see config.py
+'''
+
+#Imports the modules to connect to the database, parse requests and run the event loop
+from pymongo import AsyncMongoClient
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from bson import ObjectId
+from urllib.parse import parse_qsl
+from cache import ResponseCache
+from aggregates import TOP_INDEXES, TOP_SORT, add_reviews_update, edit_review_update, delete_review_update
+from metrics import CommandTimer, RequestMetrics, Sampled, cache_metrics, server_timing, render
+from common import (CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL, ROUTE_LABELS, LIST_INDEXES, STREAM_CHUNK_SIZE,
+                    stream_encoder, is_valid_objectid, normalize_id, to_score, has_fields, new_business_document,
+                    new_review_document, is_valid_batch, batch_status, batch_body_error, business_batch, review_batch,
+                    mark_failed_writes, business_url, review_url, get_projection, cache_view, is_current, VERSION_INDEX, VERSION_PROJECTION, get_list_options, check_ids,
+                    order_by_ids, get_top_options, get_review_page, plan_key, explain_command, QueryPlans, cursor_page_query,
+                    CursorPage)
+import asyncio, config, json, logging, os, pymongo, re, time
+
+logger = logging.getLogger(__name__)
+
+command_timer = CommandTimer() #Counts the database commands, documents and time of each request
+client = None #Created in the event loop the first time it is needed
+businesses = None #The businesses collection on that client
+limiter = asyncio.Semaphore(config.ASYNC_MAX_CONCURRENCY) #Limits the requests handled at once
+
+query_plans = QueryPlans() #Whether each query shape can be run, so each shape is only explained once
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_MAX_BYTES) #Cache of serialized business and review responses
+
+#Metrics published at /metrics
+request_metrics = RequestMetrics(ROUTE_LABELS) #Time and database work of requests, labelled by route and method
+METRICS = request_metrics.metrics + cache_metrics(response_cache) + [
+    Sampled("async_requests_in_flight", "Requests being handled or waiting for a free slot", "gauge", lambda: in_flight)
+]
+in_flight = 0 #Requests being handled or waiting for a free slot
+draining = False #Set once the server starts shutting the app down
+
+#The write-behind review queue runs on a thread with a blocking client, so only the Flask app has it
+if config.REVIEW_WRITE_BEHIND:
+    logger.warning("REVIEW_WRITE_BEHIND is only used by app.py, async_app writes each review straight away")
+
+#Returns the businesses collection, creating the client in the running event loop the first time
+def get_businesses():
+    global client, businesses
+    if client is None:
+        client = AsyncMongoClient(config.MONGO_URI, event_listeners = [command_timer], **config.client_options())
+        businesses = client[config.MONGO_DB][config.MONGO_COLLECTION]
+    return businesses
+
+'''
+These classes hold a request and a response. The query parameters and form data are kept as
+dictionaries of their first values, like Flask's request.args and request.form. A response body
+is either bytes or an async iterator of bytes, which is sent in chunks
+'''
+#Request read from the ASGI scope and body
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = first_values(scope["query_string"].decode("latin-1"))
+        self.headers = {name.decode("latin-1").lower() : value.decode("latin-1") for name, value in scope["headers"]}
+        self.body = body
+        self.form = {} #Only URL encoded forms are read
+        if self.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            self.form = first_values(body.decode("utf-8", "replace"))
+
+    #Reads the JSON body, None if it isn't JSON
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+#Response with a status, headers and a body
+class Response:
+    def __init__(self, status, body = b"", headers = None):
+        self.status, self.body = status, body
+        self.headers = headers or {}
+
+#Parses a query string or URL encoded form, keeping the first value of each name
+def first_values(text):
+    values = {}
+    for name, value in parse_qsl(text, keep_blank_values = True):
+        values.setdefault(name, value)
+    return values
+
+#Returns data as a JSON response
+def json_response(data, status):
+    return Response(status, stream_encoder.encode(data).encode(), {"content-type" : "application/json"})
+
+#Returns an error message as a JSON response
+def error_response(message, status):
+    return json_response({"error" : message}, status)
+
+'''
+This function streams documents from an async cursor as a JSON array, the same way as
+stream_json in app.py. Each document is encoded as it arrives and the output is sent in chunks,
+so the whole list is never held in memory. 'after' is a function so it can use values found
+while the documents are read
+'''
+#Streams documents from a cursor as a JSON response
+def stream_json(documents, before = "", after = None):
+    async def generate():
+        buffer = [before + "["] #Starts the array
+        buffered = len(buffer[0]) #Number of characters waiting to be sent
+        count = 0
+        async for document in documents: #Encodes each document as it arrives
+            encoded = stream_encoder.encode(document)
+            buffer.append("," + encoded if count else encoded) #Separates documents with commas
+            buffered += len(encoded) + 1
+            count += 1
+            if buffered >= STREAM_CHUNK_SIZE: #Sends the buffer once it is big enough
+                yield "".join(buffer).encode()
+                buffer, buffered = [], 0
+        buffer.append("]" + (after() if after else "")) #Ends the array
+        yield "".join(buffer).encode() #Sends whatever is left
+    return Response(200, generate(), {"content-type" : "application/json"})
+
+#Checks if an If-None-Match header holds the strong ETag
+def etag_matches(header, etag):
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or '"' + etag + '"' in tags
+
+'''
+This function returns a cached JSON response for one view of a business, the same way as
+cached_json in app.py. On a miss 'load' is awaited and returns the version and the data, or an
+error response which isn't cached. A 304 is returned if the client already has the ETag, and a
+cached view is checked against the version in the database when CACHE_REVALIDATE is set
+'''
+#Returns a view of a business from the cache, loading it on a miss
+async def cached_json(request, id, view, load):
+    cached = response_cache.get(id, view) #Looks for the view in the cache
+    if cached is not None and config.CACHE_REVALIDATE: #Checks another worker hasn't changed the business
+        if not is_current(cached, id, view, await read_version(id)):
+            response_cache.invalidate(id) #Removes the old views of the business
+            cached = None
+    if cached is None: #If the view isn't cached
+        epoch = response_cache.epoch #Notes the epoch so a load that races a write isn't stored
+        loaded = await load() #Queries the database
+        if isinstance(loaded, Response): #If the load returned an error response
+            return loaded
+        version, data = loaded
+        cached = cache_view(response_cache, id, view, version, data, epoch) #Serializes and stores the response
+
+    #Returns a 304 if the client already has this version
+    etag, body = cached
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(304, headers = {"etag" : '"' + etag + '"'})
+    return Response(200, body, {"content-type" : "application/json", "etag" : '"' + etag + '"'})
+
+#Reads the ID and version of a business from the id_version index, see read_version in app.py
+async def read_version(id):
+    collection = get_businesses()
+    try:
+        cursor = collection.find({"_id" : ObjectId(id)}, VERSION_PROJECTION).hint(VERSION_INDEX.document["name"])
+        found = await cursor.limit(1).to_list()
+    except OperationFailure: #If the index hasn't been created, the version is read from the document
+        return await collection.find_one({"_id" : ObjectId(id)}, VERSION_PROJECTION)
+    return found[0] if found else None
+
+#Finds businesses, returns None if the query would read every document and is rejected
+async def find_businesses(query, projection, sort_order):
+    collection = get_businesses()
+    cursor = collection.find(query, projection).sort(sort_order)
+    shape = plan_key(query, sort_order)
+    allowed = query_plans.allows(shape)
+    if allowed is None: #If this shape hasn't been checked yet, asks the database how it would run the query
+        explained = await collection.database.command(explain_command(collection.name, query, projection, sort_order))
+        allowed = query_plans.check(shape, explained["queryPlanner"]["winningPlan"], query)
+    return cursor if allowed else None
+
+'''
+These build the route table. A rule such as /api/v1.0/businesses/<id> is turned into a regular
+expression where each <name> matches one part of the path and is passed to the handler. The
+rule is also used as the route label of the metrics
+'''
+routes = [] #Rule, method, regular expression and handler of each route
+
+#Adds a handler to the route table
+def route(rule, method):
+    pattern = re.compile(re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", re.escape(rule)) + "$")
+    def register(handler):
+        routes.append((rule, method, pattern, handler))
+        return handler
+    return register
+
+#Finds the route for a request, returns its rule, handler and path values
+def match_route(method, path):
+    allowed = False
+    for rule, route_method, pattern, handler in routes:
+        found = pattern.match(path)
+        if found:
+            if route_method == method:
+                return rule, handler, found.groupdict()
+            allowed = True #The path exists but not for this method
+    return None, None, 405 if allowed else 404
+
+#Gets all businesses with pagination, filters and sort orders, see show_all_businesses in app.py
+@route("/api/v1.0/businesses", "GET")
+async def show_all_businesses(request):
+    error, options = get_list_options(request.args)
+    if error: #If a parameter isn't valid
+        return error_response(error, 400)
+    page_size, projection = options["page_size"], options["projection"]
+
+    #Gets the listed businesses if 'ids' is provided
+    if options["ids"]:
+        return await show_businesses_by_ids(options["ids"], projection)
+
+    #Uses cursor pagination if 'after' is provided, an empty 'after' starts from the first page
+    if options["after"] is not None:
+        return await show_businesses_after(options["after"], page_size, projection,
+                                           options["query"], options["sort"], options["sort_order"])
+
+    cursor = await find_businesses(options["query"], projection, options["sort_order"])
+    if cursor is None: #If the query would scan the whole collection
+        return error_response("This combination of filters and sort isn't supported", 400)
+    return stream_json(cursor.skip(page_size * (options["page_num"] - 1)).limit(page_size))
+
+#Gets businesses by their IDs with a single $in query, in the order the IDs were given
+async def show_businesses_by_ids(ids, projection):
+    error = check_ids(ids)
+    if error:
+        return error_response(error, 400)
+
+    found = await get_businesses().find({"_id" : {"$in" : [ObjectId(id) for id in ids]}}, projection).to_list()
+    return json_response(order_by_ids(ids, found), 200)
+
+#Gets a page of businesses after a cursor token, see show_businesses_after in app.py
+async def show_businesses_after(token, page_size, projection, query, sort, sort_order):
+    page_query = cursor_page_query(query, projection, token, sort)
+    if page_query is None: #If the token isn't valid
+        return error_response("Invalid cursor", 400)
+
+    #Queries the database for one more business than the page size
+    cursor = await find_businesses(*page_query, sort_order)
+    if cursor is None: #If the query would scan the whole collection
+        return error_response("This combination of filters and sort isn't supported", 400)
+    cursor = cursor.limit(page_size + 1)
+
+    #Passes on the businesses for the page, the page creates the next token if the extra one is returned
+    page = CursorPage(page_size, sort)
+    async def page_businesses():
+        async for business in cursor:
+            if not page.add(business):
+                break
+            yield business
+
+    return stream_json(page_businesses(), before = page.before, after = page.after)
+
+#Gets the top businesses, optionally in one town
+@route("/api/v1.0/businesses/top", "GET")
+async def show_top_businesses(request):
+    error, options = get_top_options(request.args)
+    if error:
+        return error_response(error, 400)
+    cursor = get_businesses().find(options["query"], options["projection"]).sort(TOP_SORT).limit(options["count"])
+    return stream_json(cursor) #Returns the summary of each business
+
+#Gets one business, from the cache if possible
+@route("/api/v1.0/businesses/<id>", "GET")
+async def show_one_business(request, id):
+    if not is_valid_objectid(id):
+        return error_response("Invalid business ID", 400)
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
+    projection = get_projection(request.args, []) #An empty projection returns every field
+    if projection is None: #If an unknown field was asked for
+        return error_response("Invalid fields", 400)
+
+    async def load():
+        if projection: #Includes the version when only some fields are returned
+            projection["version"] = 1
+        business = await get_businesses().find_one({"_id" : ObjectId(id)}, projection or None)
+        if business is None:
+            return error_response("Invalid business ID", 404)
+        return business.pop("version", 0), business
+
+    return await cached_json(request, id, "business?fields=" + request.args.get('fields', ""), load)
+
+#Adds a new business
+@route("/api/v1.0/businesses", "POST")
+async def add_business(request):
+    if not has_fields(request.form, ("name", "town", "rating")):
+        return error_response("Missing form data", 404)
+    rating = to_score(request.form["rating"])
+    if rating is None:
+        return error_response("Rating must be a whole number from 1 to 5", 400)
+
+    new_business = new_business_document(request.form["name"], request.form["town"], rating)
+    await get_businesses().insert_one(new_business)
+    return json_response({"url" : business_url(new_business["_id"])}, 201)
+
+#Adds a batch of businesses with one unordered bulk_write, see add_businesses_batch in app.py
+@route("/api/v1.0/businesses:batch", "POST")
+async def add_businesses_batch(request):
+    items = request.json()
+    if not is_valid_batch(items):
+        return error_response(batch_body_error("businesses"), 400)
+
+    results, operations, positions = business_batch(items)
+    if operations:
+        try:
+            await get_businesses().bulk_write(operations, ordered = False)
+        except BulkWriteError as error:
+            mark_failed_writes(results, positions, error.details) #Marks the businesses that failed
+
+    return json_response({"results" : results}, batch_status(results))
+
+#Adds a batch of reviews to a business in one update
+@route("/api/v1.0/businesses/<id>/reviews:batch", "POST")
+async def add_reviews_batch(request, id):
+    if not is_valid_objectid(id):
+        return error_response("Invalid business ID", 400)
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
+    items = request.json()
+    if not is_valid_batch(items):
+        return error_response(batch_body_error("reviews"), 400)
+
+    results, new_reviews = review_batch(id, items)
+
+    if new_reviews:
+        result = await get_businesses().update_one({"_id" : ObjectId(id)}, add_reviews_update(new_reviews))
+        response_cache.invalidate(id) #Removes the business from the cache
+        if result.matched_count == 0: #If the business does not exist
+            return error_response("Business not found", 404)
+
+    return json_response({"results" : results}, batch_status(results))
+
+#Edits a business
+@route("/api/v1.0/businesses/<id>", "PUT")
+async def edit_business(request, id):
+    if not is_valid_objectid(id):
+        return error_response("Invalid business ID", 400)
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
+    if not has_fields(request.form, ("name", "town", "rating")):
+        return error_response("Missing form data", 404)
+    rating = to_score(request.form["rating"])
+    if rating is None:
+        return error_response("Rating must be a whole number from 1 to 5", 400)
+
+    result = await get_businesses().update_one(
+        {"_id" : ObjectId(id)},
+        {"$set" : {"name" : request.form["name"], "town" : request.form["town"], "rating" : rating},
+         "$inc" : {"version" : 1}} #Increases the version so the ETag changes
+    )
+    response_cache.invalidate(id) #Removes the business from the cache
+    if result.matched_count == 0:
+        return error_response("Invalid business ID", 404)
+    return json_response({"url" : business_url(id)}, 200)
+
+#Deletes a business
+@route("/api/v1.0/businesses/<id>", "DELETE")
+async def delete_business(request, id):
+    if not is_valid_objectid(id):
+        return error_response("Invalid business ID", 400)
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
+    result = await get_businesses().delete_one({"_id" : ObjectId(id)})
+    response_cache.invalidate(id) #Removes the business from the cache
+    if result.deleted_count == 0:
+        return error_response("Invalid business ID", 404)
+    return Response(204)
+
+#Adds a review and updates the review aggregates in one update
+@route("/api/v1.0/businesses/<id>/reviews", "POST")
+async def add_new_review(request, id):
+    if not is_valid_objectid(id):
+        return error_response("Invalid business ID", 400)
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
+    if not has_fields(request.form, ("username", "comment", "stars")):
+        return error_response("Missing form data", 400)
+    stars = to_score(request.form["stars"])
+    if stars is None:
+        return error_response("Stars must be a whole number from 1 to 5", 400)
+
+    new_review = new_review_document(request.form["username"], request.form["comment"], stars)
+    result = await get_businesses().update_one({"_id" : ObjectId(id)}, add_reviews_update([new_review]))
+    response_cache.invalidate(id) #Removes the business from the cache
+    if result.matched_count == 0: #If the business does not exist
+        return error_response("Business not found", 400)
+    return json_response({"url" : review_url(id, new_review["_id"])}, 201)
+
+#Gets a page of reviews for a business with $slice, from the cache if possible
+@route("/api/v1.0/businesses/<id>/reviews", "GET")
+async def fetch_all_reviews(request, id):
+    if not is_valid_objectid(id):
+        return error_response("Invalid business ID", 400)
+    id = normalize_id(id) #Uses the lowercase ID so every form of it shares one cache entry
+    error, page = get_review_page(request.args)
+    if error: #If 'offset' or 'limit' isn't valid
+        return error_response(error, 400)
+    offset, limit = page
+
+    async def load():
+        business = await get_businesses().find_one(
+            {"_id" : ObjectId(id)}, {"version" : 1, "reviews" : {"$slice" : [offset, limit]}})
+        if not business: #If the business does not exist
+            return error_response("Business not found", 400)
+        return business.get("version", 0), business.get("reviews", [])
+
+    return await cached_json(request, id, "reviews?offset=" + str(offset) + "&limit=" + str(limit), load)
+
+#Gets one review, from the cache if possible
+@route("/api/v1.0/businesses/<bid>/reviews/<rid>", "GET")
+async def fetch_one_review(request, bid, rid):
+    if not is_valid_objectid(bid) or not is_valid_objectid(rid):
+        return error_response("Bad business ID" if not is_valid_objectid(bid) else "Bad review ID", 400)
+    bid, rid = normalize_id(bid), normalize_id(rid) #Uses the lowercase IDs so every form of them shares one cache entry
+
+    async def load():
+        business = await get_businesses().find_one(
+            {"_id" : ObjectId(bid), "reviews._id" : ObjectId(rid)}, {"_id" : 0, "reviews.$" : 1, "version" : 1})
+        if not business: #If the review doesn't exist within the business
+            return error_response("Review not found", 404)
+        return business.get("version", 0), business["reviews"][0]
+
+    return await cached_json(request, bid, "review/" + rid, load)
+
+#Edits a review and updates the review aggregates in one update
+@route("/api/v1.0/businesses/<bid>/reviews/<rid>", "PUT")
+async def edit_review(request, bid, rid):
+    if not is_valid_objectid(bid) or not is_valid_objectid(rid):
+        return error_response("Invalid business ID" if not is_valid_objectid(bid) else "Invalid review ID", 400)
+    bid, rid = normalize_id(bid), normalize_id(rid) #Uses the lowercase IDs so every form of them shares one cache entry
+    if not has_fields(request.form, ("username", "comment", "stars")):
+        return error_response("Missing form data", 400)
+    stars = to_score(request.form["stars"])
+    if stars is None:
+        return error_response("Stars must be a whole number from 1 to 5", 400)
+
+    edited_review = {"username" : request.form["username"], "comment" : request.form["comment"], "stars" : stars}
+    result = await get_businesses().update_one(
+        {"_id" : ObjectId(bid), "reviews._id" : ObjectId(rid)}, edit_review_update(ObjectId(rid), edited_review))
+    response_cache.invalidate(bid) #Removes the business from the cache
+    if result.matched_count == 0:
+        return error_response("Review not found", 404)
+    return json_response({"url" : review_url(bid, rid)}, 200)
+
+#Deletes a review and updates the review aggregates in one update
+@route("/api/v1.0/businesses/<bid>/reviews/<rid>", "DELETE")
+async def delete_review(request, bid, rid):
+    if not is_valid_objectid(bid) or not is_valid_objectid(rid):
+        return error_response("Invalid business ID" if not is_valid_objectid(bid) else "Invalid review ID", 400)
+    bid, rid = normalize_id(bid), normalize_id(rid) #Uses the lowercase IDs so every form of them shares one cache entry
+    result = await get_businesses().update_one(
+        {"_id" : ObjectId(bid), "reviews._id" : ObjectId(rid)}, delete_review_update(ObjectId(rid)))
+    response_cache.invalidate(bid) #Removes the business from the cache
+    if result.matched_count == 0: #If the business or review doesn't exist
+        return error_response("Review not found", 404)
+    return Response(204)
+
+#Gets the cache counters, used to size the cache
+@route("/api/v1.0/cache", "GET")
+async def show_cache_stats(request):
+    return json_response(response_cache.stats(), 200)
+
+'''
+These are the health checks, the same as in app.py. '/healthz' only shows the process is
+answering. '/readyz' pings the database within HEALTH_CHECK_TIMEOUT_MS and returns 503 if that
+fails or once the server has started shutting the app down, so no new requests are sent to it
+'''
+#Checks the process is running
+@route("/healthz", "GET")
+async def show_health(request):
+    return json_response({"status" : "ok", "pid" : os.getpid()}, 200)
+
+#Checks the process can reach the database and is taking requests
+@route("/readyz", "GET")
+async def show_readiness(request):
+    if draining: #If the server is shutting the app down
+        return json_response({"status" : "draining", "pid" : os.getpid()}, 503)
+    get_businesses() #Creates the client if it doesn't exist yet
+    try:
+        with pymongo.timeout(config.HEALTH_CHECK_TIMEOUT_MS / 1000): #Fails if no connection is free in time
+            await client.admin.command("ping")
+    except PyMongoError as error:
+        return json_response({"status" : "unavailable", "pid" : os.getpid(), "error" : str(error)}, 503)
+    return json_response({"status" : "ready", "pid" : os.getpid()}, 200)
+
+#Gets the metrics in the Prometheus text format
+@route("/metrics", "GET")
+async def show_metrics(request):
+    return Response(200, render(METRICS).encode(), {"content-type" : "text/plain; version=0.0.4"})
+
+#Creates the indexes for the businesses collection, does nothing if they exist
+async def ensure_indexes():
+    await get_businesses().create_indexes(LIST_INDEXES)
+    await get_businesses().create_indexes(TOP_INDEXES)
+    await get_businesses().create_indexes([VERSION_INDEX])
+
+'''
+This function handles one HTTP request. The body is read first, then the request waits for a
+free slot so no more than ASYNC_MAX_CONCURRENCY are handled at once. Like in app.py, the first
+chunk of a streamed body is read before the headers, the time and database work so far are sent
+in a Server-Timing header, and the request is added to the metrics once the whole body has been
+sent, so a streamed body's database work and time are counted too
+'''
+#Handles an HTTP request
+async def handle_http(scope, receive, send):
+    #Reads the whole body
+    chunks, more = [], True
+    while more:
+        message = await receive()
+        if message["type"] == "http.disconnect": #If the client went away
+            return
+        chunks.append(message.get("body", b""))
+        more = message.get("more_body", False)
+    request = Request(scope, b"".join(chunks))
+
+    global in_flight
+    in_flight += 1
+    try:
+        async with limiter:
+            await respond(request, send)
+    finally:
+        in_flight -= 1
+
+#Handles a request once it has a slot and sends the response
+async def respond(request, send):
+    start = time.perf_counter() #Notes when the request started
+    command_timer.reset() #Starts new database totals for this request
+    rule, handler, values = match_route(request.method, request.path)
+    if handler is None: #If no route matches
+        response = error_response("Not found" if values == 404 else "Method not allowed", values)
+    else:
+        try:
+            response = await handler(request, **values)
+            if not isinstance(response.body, bytes): #Runs the query of a streamed body and reads its first chunk
+                first = await anext(response.body)
+        except Exception: #Any error is logged and returned as a 500
+            logger.exception("Error handling %s %s", request.method, request.path)
+            response = error_response("Internal server error", 500)
+
+    #Adds the time and database work so far to the response, in milliseconds
+    seconds = time.perf_counter() - start
+    totals = command_timer.totals() #A streamed body adds to these as it is sent
+    labels = (rule or "unmatched", request.method)
+    response.headers["server-timing"] = server_timing(totals, seconds)
+
+    #Sends the response, then records the request time and database work
+    try:
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in response.headers.items()]
+        await send({"type" : "http.response.start", "status" : response.status, "headers" : headers})
+        if isinstance(response.body, bytes):
+            await send({"type" : "http.response.body", "body" : response.body})
+        else: #Sends each chunk as it is ready
+            await send({"type" : "http.response.body", "body" : first, "more_body" : True})
+            async for chunk in response.body:
+                await send({"type" : "http.response.body", "body" : chunk, "more_body" : True})
+            await send({"type" : "http.response.body", "body" : b""})
+    finally:
+        request_metrics.record(labels, response.status, time.perf_counter() - start, totals)
+
+#Handles the ASGI lifespan, creating the indexes at startup and closing the client at shutdown
+async def handle_lifespan(receive, send):
+    global draining
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await ensure_indexes() #Makes sure the indexes exist before serving requests
+            except Exception as error:
+                await send({"type" : "lifespan.startup.failed", "message" : str(error)})
+                return
+            await send({"type" : "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            draining = True #Makes /readyz return 503
+            if client is not None:
+                await client.close()
+            await send({"type" : "lifespan.shutdown.complete"})
+            return
+
+#The ASGI app
+async def app(scope, receive, send):
+    if scope["type"] == "http":
+        await handle_http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
@@ -0,0 +1,27 @@
+'''
+This is a one-off command that adds the review aggregates to businesses stored before they were
+kept up to date. It converts ratings and review stars stored as form strings to numbers, works
+out 'review_count', 'star_sum' and 'avg_stars' and creates the indexes for the top businesses query.
+
+The work is done by the database in a single update, so no business is loaded by this script.
+It is safe to run more than once, each run increases the version of every business so clients
+holding an ETag for the old data get the new data.
+
+Usage: python backfill_aggregates.py
+'''
+
+#Imports the modules to connect to the database and time the update
+from pymongo import MongoClient
+from aggregates import BACKFILL_UPDATE, TOP_INDEXES
+import time
+
+if __name__ == "__main__":
+    client = MongoClient("mongodb://127.0.0.1:27017")
+    businesses = client.dizDB.biz #Selects the collection
+
+    start = time.perf_counter()
+    result = businesses.update_many({}, BACKFILL_UPDATE) #Updates every business
+    businesses.create_indexes(TOP_INDEXES) #Creates the indexes, does nothing if they exist
+
+    print("Updated %d of %d businesses in %.1f seconds" % (
+        result.modified_count, result.matched_count, time.perf_counter() - start))
@@ -0,0 +1,434 @@
+'''
+Benchmark and regression suite for the HTTP API in app.py.
+
+It seeds a database with generated businesses, starts the app, drives each route with the
+concurrent load generator in http_load.py and reports the requests per second and the p50, p95
+and p99 latency of each one. The results are saved as JSON and compared with a stored baseline,
+and the suite exits with status 1 if any route got slower than the baseline by more than the
+threshold, so it can be run before and after a change or in CI.
+
+Scales and review profiles:
+    --scale 1k, 100k, 1m or a number     businesses to seed
+    --reviews small                      every business has a few reviews (Pareto, at most 20)
+    --reviews huge                       as small, plus 20 hot businesses with 20,000 reviews each,
+                                         which the review routes are pointed at
+
+Backends:
+    mongod   a local mongod at MONGO_URI. Data goes in a separate database (--db, default
+             dizBench) and is reused by later runs with the same seed, scale and profile. The app
+             is run with serve.py so the numbers are for the production server
+    memory   an in-memory stand-in (mongomock, only needed for this backend) for machines without
+             mongod. The app is run with Werkzeug's threaded server in a forked process. mongomock
+             can't explain queries, use positional projections or $mergeObjects, so the index
+             check is skipped and the single review and edit review routes aren't run. It
+             doesn't evaluate the review update pipelines the way mongod does, so the review
+             aggregates it returns can be wrong. It scans every document for each query, so it
+             is only useful at small scales and its numbers can't be compared with mongod's
+    auto     mongod if it answers a ping, otherwise memory (the default)
+
+Routes: list at a shallow page, a deep skip page and a deep cursor page, a filtered and sorted
+list, top businesses, one business, a batch read by IDs, a page of reviews, one review, and the
+write paths (add, batch add and edit a business, add and batch add reviews, edit and delete a
+review, delete a business). Writes go to businesses kept for the benchmark, which are reset
+afterwards on mongod. Reads run before writes. The routes that edit and delete reviews and delete
+businesses get targets of their own, made through the API just before the first of them runs, so
+the reads don't see them. Each request deletes a different target, warm-up included, so raise
+--run-targets if those routes report 404s.
+
+Usage: python benchmarks/api_suite.py [--backend auto|mongod|memory] [--scale 1k] [--reviews small]
+       [--concurrency 16] [--duration 5] [--out FILE] [--baseline FILE] [--threshold 0.2]
+       [--save-baseline] [--routes NAME ...]
+'''
+
+#Imports the modules to read arguments, seed the data, run the server and the load
+import argparse, asyncio, itertools, json, multiprocessing, os, platform, random, signal, subprocess, sys, time
+from urllib.parse import urlencode
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pymongo
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from http_load import fetch, run_load, summarize
+from make_json import generate_businesses, generate_review
+from common import MAX_BATCH_SIZE, encode_cursor
+
+SCALES = {"1k" : 1000, "100k" : 100000, "1m" : 1000000}
+REVIEW_PROFILES = {
+    "small" : {"max_reviews" : 20, "alpha" : 1.5, "hot" : 0, "hot_reviews" : 0},
+    "huge" : {"max_reviews" : 20, "alpha" : 1.5, "hot" : 20, "hot_reviews" : 20000}
+}
+WRITE_TARGETS = 100 #Businesses the write routes change
+TARGET_ROUTES = {"edit_review", "delete_review", "delete_business"} #Routes that need the targets made for each run
+TARGET_REVIEWS = 100 #Reviews added to each business made for the review routes
+SAMPLE_SIZE = 1000 #Businesses and reviews picked for the read routes
+SEED_BATCH = 1000 #Businesses per insert_many while seeding
+
+#Reads a scale such as '100k' or a number of businesses
+def parse_scale(value):
+    return SCALES[value.lower()] if value.lower() in SCALES else int(value)
+
+'''
+These functions generate and insert the data. The businesses come from make_json.py with a fixed
+seed, so every run with the same arguments stores the same data, IDs included. The hot
+businesses get one very long reviews array each, and the write targets start with no reviews
+'''
+#Generates a hot business with a huge reviews array
+def hot_business(number, review_count):
+    quality = random.uniform(1, 5)
+    reviews = [generate_review(quality) for _ in range(review_count)]
+    business = next(generate_businesses(1, 0, 1.5)) #A business with no reviews to add them to
+    star_sum = sum(review["stars"] for review in reviews)
+    business.update(name = "Bench hot %d" % number, reviews = reviews, review_count = review_count,
+                    star_sum = star_sum, avg_stars = star_sum / review_count)
+    return business
+
+#Generates every business for a run
+def generate_data(count, profile):
+    for business in generate_businesses(count, profile["max_reviews"], profile["alpha"]):
+        yield business
+    for number in range(profile["hot"]):
+        yield hot_business(number, profile["hot_reviews"])
+    for number, business in enumerate(generate_businesses(WRITE_TARGETS, 0, 1.5)):
+        business["name"] = "Bench target %d" % number
+        yield business
+
+#Inserts the businesses in batches, returns how many were inserted
+def seed(collection, count, profile, seed_value):
+    random.seed(seed_value)
+    batch, inserted = [], 0
+    for business in generate_data(count, profile):
+        batch.append(business)
+        if len(batch) == SEED_BATCH:
+            collection.insert_many(batch, ordered = False)
+            inserted += len(batch)
+            batch = []
+            print("\rSeeded %d businesses" % inserted, end = "", file = sys.stderr, flush = True)
+    if batch:
+        collection.insert_many(batch, ordered = False)
+        inserted += len(batch)
+    print("\rSeeded %d businesses" % inserted, file = sys.stderr)
+    return inserted
+
+'''
+This function picks the IDs used by the read and write routes: a sample of businesses and one
+review of each, the hot businesses and their reviews for the huge profile, the write targets,
+and the position 90% of the way through the collection for the deep pages. The sample is every
+k-th business with reviews in _id order and the hot reviews come from a seeded random, so the
+same data always gives the same sample
+'''
+#Picks the businesses and reviews the routes ask for
+def pick_samples(collection, count):
+    random.seed(1) #Picks the same hot reviews from the same data
+    with_reviews = {"review_count" : {"$gt" : 0}}
+    step = max(1, collection.count_documents(with_reviews) // SAMPLE_SIZE)
+    businesses = collection.find(with_reviews, {"_id" : 1, "review_count" : 1, "reviews" : {"$slice" : 1}}).sort("_id", 1)
+    sample = list(itertools.islice(businesses, 0, step * SAMPLE_SIZE, step))
+    samples = {
+        "ids" : [str(business["_id"]) for business in sample],
+        "reviews" : [(str(business["_id"]), str(business["reviews"][0]["_id"]), business["review_count"]) for business in sample],
+        "targets" : [str(business["_id"]) for business in
+                     collection.find({"name" : {"$regex" : "^Bench target "}}, {"_id" : 1}).sort("_id", 1)],
+        "run" : {"businesses" : [], "reviews" : []} #Targets made for this run, filled in by create_run_targets
+    }
+
+    #Points the review routes at reviews spread through the hot businesses' arrays
+    hot = list(collection.find({"name" : {"$regex" : "^Bench hot "}}, {"_id" : 1, "review_count" : 1, "reviews._id" : 1}).sort("_id", 1))
+    if hot:
+        samples["reviews"] = [
+            (str(business["_id"]), str(random.choice(business["reviews"])["_id"]), business["review_count"])
+            for business in hot for _ in range(SAMPLE_SIZE // len(hot))
+        ]
+
+    #Finds the business 90% of the way through the default order for the deep pages
+    deep = int(count * 0.9)
+    samples["deep_page"] = deep // 10 + 1
+    last = list(collection.find({}, {"_id" : 1}).sort("_id", 1).skip(deep).limit(1))
+    samples["deep_token"] = encode_cursor(("_id", 1), last[0]) if last else ""
+    return samples
+
+'''
+This function builds the routes. Each one has a name and a function that returns the method,
+path, body and content type of its nth request, cycling through the samples. Write routes that
+add businesses name them 'Bench new' so they can be removed afterwards. The delete routes take
+the next target from a count kept across runs of the route, as the warm-up uses targets too
+'''
+#Builds the routes to benchmark, in the order they are run
+def build_routes(samples):
+    ids, reviews, targets, run = samples["ids"], samples["reviews"], samples["targets"], samples["run"]
+    deleted_reviews, deleted_businesses = itertools.count(), itertools.count()
+    form = "application/x-www-form-urlencoded"
+    base = "/api/v1.0/businesses"
+
+    def get(path):
+        return ("GET", path, b"", None)
+    def post_form(method, path, fields):
+        return (method, path, urlencode(fields).encode(), form)
+    def post_json(path, data):
+        return ("POST", path, json.dumps(data).encode(), "application/json")
+
+    return [
+        ("list_shallow", False, lambda n: get(base + "?pn=1&ps=10")),
+        ("list_deep_skip", False, lambda n: get(base + "?pn=%d&ps=10" % samples["deep_page"])),
+        ("list_deep_cursor", False, lambda n: get(base + "?ps=10&after=" + samples["deep_token"])),
+        ("list_filtered", False, lambda n: get(base + "?town=Belfast&sort=-rating&ps=10")),
+        ("top", False, lambda n: get(base + "/top?town=Belfast&n=10")),
+        ("get_one", False, lambda n: get(base + "/" + ids[n % len(ids)])),
+        ("get_many", False, lambda n: get(base + "?ids=" + ",".join(ids[(n * 10 + i) % len(ids)] for i in range(10)))),
+        ("review_list", False, lambda n: get(base + "/%s/reviews?offset=%d&limit=10" % (
+            reviews[n % len(reviews)][0], (n * 7919) % max(1, reviews[n % len(reviews)][2] - 10)))),
+        ("review_get", True, lambda n: get(base + "/%s/reviews/%s" % reviews[n % len(reviews)][:2])),
+        ("add_business", False, lambda n: post_form("POST", base, {"name" : "Bench new %d" % n, "town" : "Belfast", "rating" : n % 5 + 1})),
+        ("add_business_batch", False, lambda n: post_json(base + ":batch", [
+            {"name" : "Bench new %d-%d" % (n, i), "town" : "Derry", "rating" : i % 5 + 1} for i in range(10)])),
+        ("edit_business", False, lambda n: post_form("PUT", base + "/" + targets[n % len(targets)], {
+            "name" : "Bench target %d" % (n % len(targets)), "town" : "Newry", "rating" : n % 5 + 1})),
+        ("add_review", False, lambda n: post_form("POST", base + "/%s/reviews" % targets[n % len(targets)], {
+            "username" : "bench", "comment" : "Benchmark review", "stars" : n % 5 + 1})),
+        ("add_review_batch", False, lambda n: post_json(base + "/%s/reviews:batch" % targets[n % len(targets)], [
+            {"username" : "bench", "comment" : "Benchmark review", "stars" : i % 5 + 1} for i in range(10)])),
+        ("edit_review", True, lambda n: post_form("PUT", base + "/%s/reviews/%s" % run["reviews"][n % len(run["reviews"])], {
+            "username" : "bench", "comment" : "Edited benchmark review", "stars" : n % 5 + 1})),
+        ("delete_review", False, lambda n: ("DELETE", base + "/%s/reviews/%s" % run["reviews"][
+            next(deleted_reviews) % len(run["reviews"])], b"", None)),
+        ("delete_business", False, lambda n: ("DELETE", base + "/" + run["businesses"][
+            next(deleted_businesses) % len(run["businesses"])], b"", None))
+    ]
+
+'''
+This function makes the targets of the routes that edit and delete reviews and delete
+businesses, through the batch routes of the running app so it works with either backend. It
+makes 'count' businesses to delete, and enough businesses with TARGET_REVIEWS reviews each to
+give 'count' reviews, and stores their IDs in 'run'. They are named 'Bench run' so they can be
+removed afterwards
+'''
+#Makes the businesses and reviews that the target routes change
+async def create_run_targets(base_url, count, run):
+    base = "/api/v1.0/businesses"
+    async def post(path, items):
+        status, body = await fetch(base_url, path, "POST", json.dumps(items).encode(), "application/json")
+        if status != 201:
+            raise SystemExit("Couldn't make the benchmark targets, %s returned %d" % (path, status))
+        return [result["url"].rsplit("/", 1)[1] for result in json.loads(body)["results"]]
+
+    for start in range(0, count, MAX_BATCH_SIZE):
+        run["businesses"] += await post(base + ":batch", [{"name" : "Bench run %d" % number, "town" : "Belfast", "rating" : 3}
+                                                          for number in range(start, min(count, start + MAX_BATCH_SIZE))])
+    for number in range(-(-count // TARGET_REVIEWS)): #Rounds up so there are at least 'count' reviews
+        bid = (await post(base + ":batch", [{"name" : "Bench run reviews %d" % number, "town" : "Belfast", "rating" : 3}]))[0]
+        rids = await post(base + "/%s/reviews:batch" % bid, [{"username" : "bench", "comment" : "Benchmark review", "stars" : 3}
+                                                            for _ in range(TARGET_REVIEWS)])
+        run["reviews"] += [(bid, rid) for rid in rids]
+    print("Made %d businesses and %d reviews for the target routes" % (len(run["businesses"]), len(run["reviews"])), file = sys.stderr)
+
+#Removes the businesses added by the write routes and for the target routes, and empties the write targets
+def reset_writes(collection):
+    collection.delete_many({"name" : {"$regex" : "^Bench (new|run) "}})
+    collection.update_many({"name" : {"$regex" : "^Bench target "}}, {"$set" : {
+        "reviews" : [], "review_count" : 0, "star_sum" : 0, "avg_stars" : None}})
+
+'''
+These functions start the app. With mongod, serve.py is run in its own process pointed at the
+benchmark database. With the stand-in, the process is forked after seeding so it has its own copy
+of the in-memory data, and the app's collection is swapped for it
+'''
+#Starts serve.py against the benchmark database
+def start_mongod_server(args):
+    env = dict(os.environ, MONGO_URI = args.uri, MONGO_DB = args.db, MONGO_COLLECTION = "biz")
+    return subprocess.Popen([sys.executable, "serve.py", "--port", str(args.port), "--workers", str(args.workers)],
+                            cwd = ROOT, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+#Serves the app on the in-memory collection, runs in the forked process
+def serve_memory(collection, port):
+    import app
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    WSGIRequestHandler.log_request = lambda *args, **kwargs: None #Doesn't log every request
+    app.businesses = collection
+    app.find_businesses = lambda query, projection, sort_order: collection.find(query, projection).sort(sort_order) #mongomock can't explain
+    make_server("127.0.0.1", port, app.app, threaded = True).serve_forever()
+
+#Waits until the server answers the path with a 200
+async def wait_until_ready(base_url, path, timeout = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _ = await fetch(base_url, path)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("The server didn't become ready in %d seconds" % timeout)
+
+#Runs every route and returns a summary of each, making the targets before the first route that needs them
+async def run_routes(base_url, routes, args, run):
+    results = {}
+    print("%-20s %10s %9s %9s %9s %7s" % ("route", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+    for name, make_request in routes:
+        if name in TARGET_ROUTES and not run["businesses"]:
+            await create_run_targets(base_url, args.run_targets, run)
+        await run_load(base_url, make_request, args.concurrency, duration = args.warmup) #Warms the caches and pools
+        summary = summarize(*await run_load(base_url, make_request, args.concurrency, duration = args.duration))
+        summary["errors"] = summary["failures"] + sum(count for status, count in summary["statuses"].items() if int(status) >= 400) #Requests the route rejected mean it wasn't measured
+        results[name] = summary
+        print("%-20s %10.1f %9s %9s %9s %7d" % (name, summary["rps"], summary["p50_ms"], summary["p95_ms"],
+                                                 summary["p99_ms"], summary["errors"]), flush = True)
+    return results
+
+'''
+This function compares the results with the baseline. A route has regressed if its p95 latency
+grew or its requests per second fell by more than the threshold, or if it has errors that the
+baseline didn't. Latency changes under --min-ms are ignored so fast routes don't fail on noise
+'''
+#Returns the routes that got slower than the baseline
+def find_regressions(results, baseline, threshold, min_ms):
+    regressions = []
+    for name, current in results["routes"].items():
+        before = baseline["routes"].get(name)
+        if not before or "skipped" in current or "skipped" in before:
+            continue
+        if current["p95_ms"] is not None and before["p95_ms"] is not None and \
+           current["p95_ms"] > before["p95_ms"] * (1 + threshold) and current["p95_ms"] - before["p95_ms"] > min_ms:
+            regressions.append("%s p95 %.2f ms -> %.2f ms" % (name, before["p95_ms"], current["p95_ms"]))
+        if current["rps"] < before["rps"] * (1 - threshold):
+            regressions.append("%s throughput %.1f -> %.1f req/s" % (name, before["rps"], current["rps"]))
+        if current["errors"] and not before["errors"]:
+            regressions.append("%s has %d errors" % (name, current["errors"]))
+    return regressions
+
+#Returns the short ID of the current commit, or None outside a git checkout
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = ROOT, stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#Checks if a mongod answers at the URI
+def mongod_available(uri):
+    try:
+        MongoClient(uri, serverSelectionTimeoutMS = 1000).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+def main(args):
+    count = parse_scale(args.scale)
+    profile = REVIEW_PROFILES[args.reviews]
+    backend = args.backend
+    if backend == "auto":
+        backend = "mongod" if mongod_available(args.uri) else "memory"
+        print("Using the %s backend" % backend, file = sys.stderr)
+
+    #Seeds the data, reusing a mongod database seeded with the same arguments
+    if backend == "mongod":
+        client = MongoClient(args.uri)
+        collection = client[args.db]["biz"]
+        marker = {"_id" : "seed", "count" : count, "reviews" : args.reviews, "seed" : args.seed}
+        if args.reseed or client[args.db]["meta"].find_one({"_id" : "seed"}) != marker:
+            collection.drop()
+            seed(collection, count, profile, args.seed)
+            client[args.db]["meta"].replace_one({"_id" : "seed"}, marker, upsert = True)
+        reset_writes(collection)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("No mongod at %s and mongomock isn't installed for the in-memory backend" % args.uri)
+        collection = mongomock.MongoClient().bench.biz
+        seed(collection, count, profile, args.seed)
+    samples = pick_samples(collection, count)
+
+    #Starts the app and waits until it is ready
+    if backend == "mongod":
+        server = start_mongod_server(args)
+        ready_path = "/readyz"
+    else:
+        server = multiprocessing.get_context("fork").Process(target = serve_memory, args = (collection, args.port), daemon = True)
+        server.start()
+        ready_path = "/healthz"
+    base_url = "http://127.0.0.1:%d" % args.port
+
+    #Runs the routes, skipping those the backend can't serve
+    routes, skipped = [], []
+    for name, needs_mongod, make_request in build_routes(samples):
+        if args.routes and name not in args.routes:
+            continue
+        if needs_mongod and backend != "mongod":
+            skipped.append(name)
+        else:
+            routes.append((name, make_request))
+    try:
+        asyncio.run(wait_until_ready(base_url, ready_path))
+        route_results = asyncio.run(run_routes(base_url, routes, args, samples["run"]))
+    finally: #Stops the server, draining it on mongod
+        if backend == "mongod":
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+            reset_writes(collection)
+        else:
+            server.terminate()
+    for name in skipped:
+        route_results[name] = {"skipped" : "not supported by the %s backend" % backend}
+
+    results = {
+        "meta" : {
+            "backend" : backend, "scale" : count, "reviews" : args.reviews, "seed" : args.seed,
+            "concurrency" : args.concurrency, "duration" : args.duration, "workers" : args.workers if backend == "mongod" else 1,
+            "commit" : git_commit(), "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python" : platform.python_version(), "pymongo" : pymongo.version, "machine" : platform.machine()
+        },
+        "routes" : route_results
+    }
+    with open(args.out, "w") as fout:
+        json.dump(results, fout, indent = 2)
+    print("Saved the results to " + args.out, file = sys.stderr)
+
+    #Saves the results as the baseline, or checks them against it
+    baseline_path = args.baseline or os.path.join(ROOT, "benchmarks", "baselines", "%s-%s-%s.json" % (backend, args.scale, args.reviews))
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok = True)
+        with open(baseline_path, "w") as fout:
+            json.dump(results, fout, indent = 2)
+        print("Saved the baseline to " + baseline_path, file = sys.stderr)
+        return
+    if not os.path.exists(baseline_path):
+        print("No baseline at %s, run with --save-baseline to create one" % baseline_path, file = sys.stderr)
+        return
+    with open(baseline_path) as fin:
+        baseline = json.load(fin)
+    for key in ("backend", "scale", "reviews", "concurrency"): #Only like for like runs can be compared
+        if baseline["meta"][key] != results["meta"][key]:
+            raise SystemExit("The baseline was run with %s=%s, this run has %s" % (key, baseline["meta"][key], results["meta"][key]))
+
+    regressions = find_regressions(results, baseline, args.threshold, args.min_ms)
+    if regressions:
+        print("Regressions against %s (commit %s):" % (baseline_path, baseline["meta"]["commit"]))
+        for regression in regressions:
+            print("  " + regression)
+        raise SystemExit(1)
+    print("No route is more than %d%% slower than the baseline" % (args.threshold * 100))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks every route of the API and checks for regressions")
+    parser.add_argument("--backend", choices = ["auto", "mongod", "memory"], default = "auto")
+    parser.add_argument("--uri", default = os.environ.get("MONGO_URI", "mongodb://127.0.0.1:27017"))
+    parser.add_argument("--db", default = "dizBench", help = "database the benchmark data is kept in")
+    parser.add_argument("--scale", default = "1k", help = "businesses to seed: 1k, 100k, 1m or a number")
+    parser.add_argument("--reviews", choices = sorted(REVIEW_PROFILES), default = "small", help = "review profile")
+    parser.add_argument("--seed", type = int, default = 42, help = "random seed for the data")
+    parser.add_argument("--reseed", action = "store_true", help = "seed mongod again even if the data matches")
+    parser.add_argument("--port", type = int, default = 2100, help = "port the app is run on")
+    parser.add_argument("--workers", type = int, default = 1, help = "serve.py workers, mongod only")
+    parser.add_argument("--concurrency", type = int, default = 16, help = "requests in flight at once")
+    parser.add_argument("--duration", type = float, default = 5, help = "seconds each route is measured for")
+    parser.add_argument("--warmup", type = float, default = 1, help = "seconds each route runs before it is measured")
+    parser.add_argument("--routes", nargs = "+", help = "only run these routes")
+    parser.add_argument("--run-targets", type = int, default = 20000,
+                        help = "businesses and reviews made for each of the routes that delete them")
+    parser.add_argument("--out", default = "bench-results.json", help = "file to save the results to")
+    parser.add_argument("--baseline", help = "baseline to compare with, defaults to benchmarks/baselines/<backend>-<scale>-<reviews>.json")
+    parser.add_argument("--save-baseline", action = "store_true", help = "save the results as the baseline instead of comparing")
+    parser.add_argument("--threshold", type = float, default = 0.2, help = "fraction slower that counts as a regression")
+    parser.add_argument("--min-ms", type = float, default = 1.0, help = "p95 changes smaller than this are ignored")
+    main(parser.parse_args())
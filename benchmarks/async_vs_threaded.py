@@ -0,0 +1,65 @@
+'''
+Compares the threaded Flask server in app.py with the asyncio app in async_app.py at rising
+concurrency. Both must be running against the same database, for example:
+
+    python app.py                                   (Flask, port 2000)
+    uvicorn async_app:app --port 2001 --log-level warning
+
+For each concurrency, every server gets the same mix of requests for 'duration' seconds: list
+pages, one business and the reviews of a business, using IDs read from the first page. It
+reports requests per second, p50/p95/p99 latency and failed requests, and can save the results
+as JSON. Failures include connections the server refused or dropped, which is how the threaded
+server usually gives way once it runs out of threads or sockets.
+
+Usage: python benchmarks/async_vs_threaded.py [--flask URL] [--asgi URL] [--concurrency N ...]
+       [--duration SECONDS] [--out results.json]
+'''
+
+#Imports the modules to read arguments, run the load and write the results
+import argparse, asyncio, json, os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from http_load import fetch, run_load, summarize
+
+#Reads the IDs of the first page of businesses so the mix can ask for them
+async def find_ids(base_url):
+    status, body = await fetch(base_url, "/api/v1.0/businesses?ps=100")
+    if status != 200:
+        raise SystemExit("%s returned %d for the list of businesses" % (base_url, status))
+    return [business["_id"] for business in json.loads(body)]
+
+#Returns the request mix, cycling through list pages, businesses and reviews
+def request_mix(ids):
+    paths = []
+    for number, id in enumerate(ids):
+        paths.append("/api/v1.0/businesses?pn=%d&ps=10" % (number % 10 + 1))
+        paths.append("/api/v1.0/businesses/" + id)
+        paths.append("/api/v1.0/businesses/" + id + "/reviews?limit=10")
+    return lambda number: ("GET", paths[number % len(paths)], b"", None)
+
+async def main(args):
+    servers = {"flask" : args.flask, "asgi" : args.asgi}
+    mixes = {name : request_mix(await find_ids(url)) for name, url in servers.items()}
+
+    results = []
+    print("%-6s %11s %10s %9s %9s %9s %9s" % ("server", "concurrency", "req/s", "p50 ms", "p95 ms", "p99 ms", "failures"))
+    for concurrency in args.concurrency:
+        for name, url in servers.items():
+            summary = summarize(*await run_load(url, mixes[name], concurrency, duration = args.duration))
+            results.append(dict(summary, server = name, concurrency = concurrency))
+            print("%-6s %11d %10.1f %9s %9s %9s %9d" % (name, concurrency, summary["rps"], summary["p50_ms"],
+                                                         summary["p95_ms"], summary["p99_ms"], summary["failures"]), flush = True)
+            await asyncio.sleep(1) #Lets the server close its connections before the next run
+
+    if args.out:
+        with open(args.out, "w") as fout:
+            json.dump(results, fout, indent = 2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Compares the threaded Flask server with the asyncio app")
+    parser.add_argument("--flask", default = "http://127.0.0.1:2000", help = "URL of the Flask server")
+    parser.add_argument("--asgi", default = "http://127.0.0.1:2001", help = "URL of the asyncio app")
+    parser.add_argument("--concurrency", type = int, nargs = "+", default = [10, 100, 500, 1000], help = "requests in flight at once")
+    parser.add_argument("--duration", type = float, default = 10, help = "seconds each run lasts")
+    parser.add_argument("--out", help = "file to save the results to as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,123 @@
+'''
+A small concurrent HTTP load generator used by the benchmarks. Each simulated client is an
+asyncio task with its own keep-alive connection, which sends a request, reads the whole response
+and sends the next one, so the concurrency is the number of requests in flight at once. It only
+speaks plain HTTP/1.1 with Content-Length or chunked bodies, which is all the two apps send, and
+needs nothing outside the standard library.
+'''
+
+#Imports the modules to open connections, time requests and parse URLs
+import asyncio, time
+from urllib.parse import urlsplit
+
+#Reads one response, returns its status, whether the connection can be reused and the body
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed")
+    version, status = status_line.split(b" ", 2)[:2]
+    headers = {}
+    while True: #Reads the headers up to the blank line
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip().lower()
+
+    status = int(status)
+    keep_alive = headers.get(b"connection") != b"close" and version == b"HTTP/1.1"
+    if status in (204, 304):
+        body = b""
+    elif headers.get(b"transfer-encoding") == b"chunked": #Reads each chunk until the empty one
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            chunk = await reader.readexactly(size + 2) #The chunk and its line ending
+            if size == 0:
+                break
+            chunks.append(chunk[:-2])
+        body = b"".join(chunks)
+    elif b"content-length" in headers:
+        body = await reader.readexactly(int(headers[b"content-length"]))
+    else: #The body ends when the connection is closed
+        body, keep_alive = await reader.read(), False
+    return status, keep_alive, body
+
+#Builds the bytes of a request
+def build_request(host, method, path, body = b"", content_type = None):
+    lines = ["%s %s HTTP/1.1" % (method, path), "Host: " + host, "Content-Length: %d" % len(body)]
+    if content_type:
+        lines.append("Content-Type: " + content_type)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+'''
+This function runs the load. 'make_request' is called with the number of the request and returns
+its method, path, body and content type. Clients keep sending requests until 'duration' seconds
+have passed or 'total' requests have been sent. It returns the latency in seconds of every
+request that got a response, a count of each status, the number of failed requests and the
+time taken
+'''
+#Sends requests from 'concurrency' clients at once
+async def run_load(base_url, make_request, concurrency, duration = None, total = None):
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    latencies, statuses, failures = [], {}, [0]
+    sent = [0] #Number of requests started by all the clients
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def client():
+        reader = writer = None
+        while (deadline is None or time.perf_counter() < deadline) and (total is None or sent[0] < total):
+            number = sent[0]
+            sent[0] += 1
+            method, path, body, content_type = make_request(number)
+            try:
+                if writer is None: #Opens a connection, or a new one after it was closed
+                    reader, writer = await asyncio.open_connection(host, port)
+                start = time.perf_counter()
+                writer.write(build_request(url.netloc, method, path, body, content_type))
+                status, keep_alive, _ = await read_response(reader)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+            except (OSError, ValueError, asyncio.IncompleteReadError): #If the request failed
+                failures[0] += 1
+                keep_alive = False
+            if not keep_alive and writer is not None:
+                writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, statuses, failures[0], time.perf_counter() - started
+
+#Returns the value at a percentile of sorted values
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+#Summarises a load run as requests per second and latency percentiles in milliseconds
+def summarize(latencies, statuses, failures, seconds):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        "requests" : len(latencies), "failures" : failures,
+        "statuses" : {str(status) : count for status, count in sorted(statuses.items())},
+        "rps" : round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "p50_ms" : ms(percentile(latencies, 0.50)),
+        "p95_ms" : ms(percentile(latencies, 0.95)),
+        "p99_ms" : ms(percentile(latencies, 0.99))
+    }
+
+#Sends one request and returns its status and body, used to look up or create data before a run
+async def fetch(base_url, path, method = "GET", body = b"", content_type = None):
+    url = urlsplit(base_url)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    try:
+        writer.write(build_request(url.netloc, method, path, body, content_type))
+        status, _, body = await read_response(reader)
+        return status, body
+    finally:
+        writer.close()
@@ -0,0 +1,75 @@
+'''
+Compares the streaming JSON response used by the list routes with the old path, which built a
+full list, converted every ObjectId with str() and then called jsonify on the whole thing.
+
+Businesses are generated in memory and handed out one at a time like a pymongo cursor, so the
+numbers measure only the encoding side and no database is needed. For each page size it reports
+the peak memory (tracemalloc), the time until the first chunk is ready and the total time. Times
+include generating the fake businesses, which is the same for both paths.
+
+Usage: python benchmarks/stream_vs_jsonify.py [page sizes...]
+'''
+
+#Imports the modules to time, trace memory and to load the app from the parent folder
+import os, sys, time, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from flask import jsonify
+from app import app, stream_json
+
+#Generates businesses one at a time, like a database cursor
+def fake_cursor(count, reviews_per_business):
+    for i in range(count):
+        yield {
+            "_id" : ObjectId(), "name" : "Biz " + str(i), "town" : "Belfast", "rating" : 4,
+            "reviews" : [
+                {"_id" : ObjectId(), "username" : "user" + str(r), "comment" : "Good " * 20, "stars" : 4}
+                for r in range(reviews_per_business)
+            ]
+        }
+
+#The old path, builds the whole list then encodes it
+def jsonify_path(cursor):
+    data_to_return = []
+    for business in cursor:
+        business['_id'] = str(business['_id'])
+        for review in business['reviews']:
+            review['_id'] = str(review['_id'])
+        data_to_return.append(business)
+    response = jsonify(data_to_return)
+    return iter([response.get_data()])
+
+#The streaming path, encodes each business as it is read
+def stream_path(cursor):
+    return stream_json(cursor).response
+
+#Runs one path and reads it like the server writing it to the socket
+def run(path, count, reviews_per_business):
+    start = time.perf_counter()
+    first = None
+    for chunk in path(fake_cursor(count, reviews_per_business)):
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+#Measures the time of one path, then its peak memory in a second run as tracing slows it down
+def measure(path, count, reviews_per_business):
+    first, total = run(path, count, reviews_per_business)
+    tracemalloc.start()
+    run(path, count, reviews_per_business)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"first_ms" : first * 1000, "total_ms" : total * 1000, "peak_mb" : peak / 2 ** 20}
+
+if __name__ == "__main__":
+    page_sizes = [int(size) for size in sys.argv[1:]] or [100, 1000, 10000]
+    reviews_per_business = 20
+
+    print("%8s  %-8s %10s %10s %10s" % ("page", "path", "first ms", "total ms", "peak MB"))
+    with app.app_context():
+        for page_size in page_sizes:
+            for name, path in (("jsonify", jsonify_path), ("stream", stream_path)):
+                result = measure(path, page_size, reviews_per_business)
+                print("%8d  %-8s %10.1f %10.1f %10.1f" % (
+                    page_size, name, result["first_ms"], result["total_ms"], result["peak_mb"]))
@@ -0,0 +1,90 @@
+'''
+This is an in-process cache for the serialized responses of a business. Each view of a business
+(the business itself, a page of its reviews or one review) is an entry of its own, and an index
+of the views of each business lets every view be removed at once when the business is changed.
+
+The least recently used views are evicted when the cache holds more than 'max_entries' views or
+more than 'max_bytes' of responses, so one business with many views can't grow the cache without
+limit. Each view expires after a time to live and an expired view is removed when it is found.
+Hit, miss and eviction counters are kept so the cache can be sized.
+
+The cache belongs to one process and is only invalidated by that process's writes. When several
+worker processes serve the API, the apps can check a cached view against the version of the
+business in the database before using it, see CACHE_REVALIDATE in config.py.
+'''
+
+#Imports the modules to keep entries in order of use, lock them between threads and check expiry
+from collections import OrderedDict
+import threading, time
+
+#Cache of serialized responses, keyed by business ID and view
+class ResponseCache:
+    def __init__(self, max_entries, ttl, max_bytes = None):
+        self.max_entries = max_entries #Largest number of views to keep
+        self.max_bytes = max_bytes #Largest total size of the cached responses, None for no limit
+        self.ttl = ttl #Seconds a view is kept for
+        self.entries = OrderedDict() #(Business ID, view) to its value, expiry and size, least recently used first
+        self.views = {} #Business ID to the views cached for it, used to invalidate a business
+        self.size = 0 #Total size of the cached responses
+        self.lock = threading.Lock() #Stops threads changing the entries at the same time
+        self.epoch = 0 #Increased on every invalidation so loads that raced a write aren't stored
+        self.hits, self.misses, self.evictions, self.invalidations = 0, 0, 0, 0
+
+    #Removes one view, the lock must be held
+    def remove(self, key):
+        value, expires, size = self.entries.pop(key)
+        self.size -= size
+        views = self.views[key[0]]
+        views.discard(key[1])
+        if not views: #If it was the last view of the business
+            del self.views[key[0]]
+
+    #Returns the cached value of a view, or None if it isn't cached or has expired
+    def get(self, id, view):
+        key = (id, view)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is None or cached[1] < time.monotonic(): #If the view is missing or expired
+                if cached is not None: #Removes the expired view so it doesn't take up space
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key) #Marks the view as most recently used
+            self.hits += 1
+            return cached[0]
+
+    #Stores the value of a view, unless the cache was invalidated since 'epoch' was read
+    def put(self, id, view, value, epoch, size = 0):
+        key = (id, view)
+        with self.lock:
+            if epoch != self.epoch: #If a write happened while the value was loaded
+                return
+            if key in self.entries: #Replaces a view that is already cached
+                self.remove(key)
+            self.entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.views.setdefault(id, set()).add(view)
+            self.size += size
+            #Evicts the least recently used views until the cache is within its limits
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes and len(self.entries) > 1):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    #Removes every view of a business, called after the business is changed or deleted
+    def invalidate(self, id):
+        with self.lock:
+            self.epoch += 1
+            views = self.views.get(id)
+            if views:
+                for view in list(views):
+                    self.remove((id, view))
+                self.invalidations += 1
+
+    #Returns the counters and the size of the cache
+    def stats(self):
+        with self.lock:
+            return {
+                "entries" : len(self.entries), "max_entries" : self.max_entries, "businesses" : len(self.views),
+                "bytes" : self.size, "max_bytes" : self.max_bytes, "ttl" : self.ttl,
+                "hits" : self.hits, "misses" : self.misses,
+                "evictions" : self.evictions, "invalidations" : self.invalidations
+            }
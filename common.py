@@ -0,0 +1,543 @@
+'''
+This holds the validation, query building and serialization shared by the Flask app in app.py and
+the asyncio app in async_app.py, so both serve the same API in the same way. Nothing here talks to
+the database or depends on the web framework, query parameters and form data are passed in as
+mappings with a get() method.
+'''
+
+#Imports the modules to build IDs, indexes, writes, tokens and ETags
+from pymongo import IndexModel, InsertOne, ASCENDING
+from bson import ObjectId
+import base64, config, json, logging, re, threading, zlib
+
+logger = logging.getLogger(__name__)
+
+#Values for pagination
+MAX_PAGE_SIZE = 100 #Largest page size a client can ask for
+MAX_PAGE_NUM = 100000 #Largest page number, deeper pages should use cursor pagination
+MAX_BATCH_SIZE = 1000 #Largest number of businesses or reviews added by one batch request
+MAX_REVIEW_OFFSET = 100000 #Largest offset into the reviews of a business
+SORT_FIELDS = ["_id", "name", "town", "rating"] #Fields a page can be ordered by, '_id' breaks any ties
+SORT_VALUE_TYPES = {"name" : str, "town" : str, "rating" : (int, float)} #Types of the sort value in a cursor token
+
+#Indexes for the list filters and sort orders, each ends with '_id' so ties keep a fixed order
+LIST_INDEXES = [
+    IndexModel([("town", ASCENDING), ("_id", ASCENDING)], name = "town"),
+    IndexModel([("town", ASCENDING), ("rating", ASCENDING), ("_id", ASCENDING)], name = "town_rating"),
+    IndexModel([("town", ASCENDING), ("name", ASCENDING), ("_id", ASCENDING)], name = "town_name"),
+    IndexModel([("rating", ASCENDING), ("_id", ASCENDING)], name = "rating"),
+    IndexModel([("name", ASCENDING), ("_id", ASCENDING)], name = "name"),
+    IndexModel([("reviews._id", ASCENDING)], name = "review_id") #Finds a business from one of its reviews
+]
+
+#Fields that can be returned for a business
+SUMMARY_FIELDS = ["name", "town", "rating", "review_count", "avg_stars"] #Fields returned by the list view by default
+SELECTABLE_FIELDS = SUMMARY_FIELDS + ["star_sum", "reviews"] #Fields a client can ask for with 'fields'
+
+#Values for streaming responses
+STREAM_CHUNK_SIZE = 64 * 1024 #Encoded JSON is sent once this many characters are buffered
+
+#Cache of serialized business and review responses
+CACHE_MAX_ENTRIES = 10000 #Largest number of views kept in the cache
+CACHE_MAX_BYTES = 64 * 1024 * 1024 #Largest total size of the cached responses
+CACHE_TTL = 60 #Seconds a cached response is kept for
+
+#Labels of the request metrics published at /metrics
+ROUTE_LABELS = ("route", "method")
+
+#Start of the URLs returned for new and edited businesses and reviews
+BUSINESSES_URL = "http://127.0.0.1:2000/api/v1.0/businesses/"
+
+#Returns the URL of a business
+def business_url(id):
+    return BUSINESSES_URL + str(id)
+
+#Returns the URL of a review
+def review_url(bid, rid):
+    return BUSINESSES_URL + str(bid) + "/reviews/" + str(rid)
+
+#Encodes ObjectIds as strings, any other type JSON can't encode is an error
+def json_default(value):
+    if isinstance(value, ObjectId): #If the value is an ObjectId
+        return str(value) #Returns the ID as a string
+    raise TypeError("Can't encode " + type(value).__name__)
+
+stream_encoder = json.JSONEncoder(default = json_default, separators = (",", ":")) #Compact ObjectId aware encoder
+
+'''
+This function validates the ID by ensuring it's a 24 character hexadecimal string. It checks
+if the length of the ID is exactly 24. If not, it returns Flase. Then, it iterates through
+each character in the ID to check if it's a valid hexadecimal character. If any character
+isn't a valid hexadecimal digit, it returns False. If all checks pass, it returns True which
+indicates that the ID is valid
+'''
+#Validation for ObjectID
+def is_valid_objectid(id):
+    #Checks if the ID length is 24
+    if len(id) != 24: #If ID length is equal to 24
+        return False #Returns False if the length is not 24
+
+    #Checks if all characters are hexadecimal
+    hex_digits =  "0123456789abcdefABCDEF" #String of hexadecimal characters
+
+    for char in id: #Iterates over each character in the ID
+        if char not in hex_digits: #Checks if the character is not in the 'hex_digits' list
+            return False #Returns False if any character is not a hexadecimal
+    return True #Returns True if the ID is valid
+
+#Returns a valid ID in lowercase, so an ID in any case gives the same cache key, ETag and URL
+def normalize_id(id):
+    return str(ObjectId(id))
+
+'''
+This function reads an optional whole number from the query parameters. If the parameter is
+missing or empty the default is returned, otherwise it is converted to an integer. A ValueError
+is raised if the value isn't a whole number so the route can return a 400 response
+'''
+#Reads an integer query parameter
+def get_int_arg(args, name, default):
+    value = args.get(name) #Retrieves the parameter if it exists
+    if not value: #If the parameter is missing or empty
+        return default #Returns the default value
+    return int(value) #Converts the value to an integer, raises ValueError if it isn't one
+
+'''
+This function converts a rating or star score from the form data or JSON to a number, so scores
+can be summed and sorted by the database. None is returned if the score isn't a whole number
+from 1 to 5
+'''
+#Converts a form or JSON value to a score from 1 to 5
+def to_score(value):
+    try:
+        score = int(value) #Converts the score to an integer
+    except (ValueError, TypeError): #If the score isn't a whole number
+        return None
+    return score if 1 <= score <= 5 else None #Checks the score is in range
+
+'''
+These functions create new business and review documents, used when they are added one at a
+time from form data and when they are added in batches from JSON. New businesses start with no
+reviews, empty review aggregates and version 0
+'''
+#Checks the form data has every field
+def has_fields(form, fields):
+    return all(field in form for field in fields)
+
+#Creates a new business
+def new_business_document(name, town, rating):
+    return {
+        "_id" : ObjectId(), #Generates a new ObjectId for the business
+        "name" : name, "town" : town, "rating" : rating,
+        "reviews" : [], #Initializes 'reviews' as an empty list
+        "review_count" : 0, "star_sum" : 0, "avg_stars" : None, #Initializes the review aggregates
+        "version" : 0 #Initializes the version used by the ETag
+    }
+
+#Creates a new review
+def new_review_document(username, comment, stars):
+    return {
+        "_id" : ObjectId(), #Generates a new ObjectId for the review
+        "username" : username, "comment" : comment, "stars" : stars
+    }
+
+'''
+This function checks one item of a batch request. The item must be a JSON object with every
+required field as a string, apart from the score field which must be a whole number from 1 to 5.
+It returns an error message, or None if the item is valid
+'''
+#Checks the fields of one batch item
+def check_batch_item(item, text_fields, score_field):
+    if not isinstance(item, dict):
+        return "Item must be an object"
+    if any(not isinstance(item.get(field), str) for field in text_fields): #Checks the text fields
+        return "Missing " + ", ".join(text_fields)
+    if to_score(item.get(score_field)) is None: #Checks the score
+        return score_field.capitalize() + " must be a whole number from 1 to 5"
+    return None
+
+#Checks the body of a batch request is a list of the right size
+def is_valid_batch(items):
+    return isinstance(items, list) and 1 <= len(items) <= MAX_BATCH_SIZE
+
+#Status of a batch, 201 if every item was added, 207 if some were and 400 if none were
+def batch_status(results):
+    added = sum(1 for result in results if result["status"] == 201)
+    return 201 if added == len(results) else 207 if added else 400
+
+#Error message for a batch body that isn't a list of the right size
+def batch_body_error(kind):
+    return "Body must be a JSON list of 1 to " + str(MAX_BATCH_SIZE) + " " + kind
+
+'''
+These functions build the writes of the batch routes. Each item is checked and given a result,
+in the order the items were given, with a URL for the valid ones and an error for the rest. If
+some of the writes then fail, their results are replaced with the database's error
+'''
+#Builds the inserts for a batch of businesses, returns the results, the inserts and the item of each insert
+def business_batch(items):
+    results, operations, positions = [], [], [] #'positions' maps each insert back to its item
+    for index, item in enumerate(items):
+        error = check_batch_item(item, ["name", "town"], "rating")
+        if error:
+            results.append({"index" : index, "status" : 400, "error" : error})
+            continue
+        new_business = new_business_document(item["name"], item["town"], to_score(item["rating"]))
+        results.append({"index" : index, "status" : 201, "url" : business_url(new_business["_id"])})
+        operations.append(InsertOne(new_business))
+        positions.append(index)
+    return results, operations, positions
+
+#Builds the new reviews for a batch of reviews on a business, returns the results and the reviews
+def review_batch(id, items):
+    results, new_reviews = [], []
+    for index, item in enumerate(items):
+        error = check_batch_item(item, ["username", "comment"], "stars")
+        if error:
+            results.append({"index" : index, "status" : 400, "error" : error})
+            continue
+        new_review = new_review_document(item["username"], item["comment"], to_score(item["stars"]))
+        results.append({"index" : index, "status" : 201, "url" : review_url(id, new_review["_id"])})
+        new_reviews.append(new_review)
+    return results, new_reviews
+
+#Marks the items whose writes failed, from the details of a BulkWriteError
+def mark_failed_writes(results, positions, details):
+    for write_error in details["writeErrors"]:
+        index = positions[write_error["index"]] #The item of the failed write
+        results[index] = {"index" : index, "status" : 500, "error" : write_error["errmsg"]}
+
+'''
+This function builds the projection for a business query. If the 'fields' parameter is given it
+must be a comma separated list of selectable fields, otherwise the default fields are used.
+None is returned if an unknown field is asked for, and an empty projection means every field
+'''
+#Builds a projection from the 'fields' query parameter
+def get_projection(args, default_fields):
+    fields = default_fields #Uses the default fields if 'fields' isn't given
+    if args.get('fields'): #Retrieves the 'fields' parameter if it exists
+        fields = args.get('fields').split(",") #Splits the list of fields
+        if any(field not in SELECTABLE_FIELDS for field in fields): #Checks every field can be selected
+            return None
+
+    projection = {} #Starts with an empty projection
+    for field in fields: #Adds each field to the projection
+        projection[field] = 1
+    return projection
+
+#Builds the ETag of a view of a business from its ID, its version and the view
+def make_etag(id, version, view):
+    return id + "-" + str(version) + "-" + format(zlib.crc32(view.encode()), "x")
+
+#Index and projection that read only the version of a business, to check a cached view is still current. The _id
+#index is skipped by hinting this one, so the version is read from the index without loading the document
+VERSION_INDEX = IndexModel([("_id", ASCENDING), ("version", ASCENDING)], name = "id_version")
+VERSION_PROJECTION = {"_id" : 1, "version" : 1}
+
+#Returns whether a cached view was made from the business as it is now, 'business' holds only its version
+def is_current(cached, id, view, business):
+    return business is not None and cached[0] == make_etag(id, business.get("version", 0), view)
+
+#Serializes a view loaded from the database and stores it in the cache, returns its ETag and body
+def cache_view(cache, id, view, version, data, epoch):
+    cached = (make_etag(id, version, view), stream_encoder.encode(data).encode()) #Serializes the response once
+    cache.put(id, view, cached, epoch, len(cached[1])) #Stores the serialized response and its size
+    return cached
+
+'''
+This function builds the filter for the list of businesses from the query parameters. 'town'
+matches a town exactly, 'min_rating' and 'max_rating' give a range of ratings and 'name' matches
+names starting with the given text. A ValueError is raised if a rating isn't a whole number
+from 1 to 5
+'''
+#Builds the query filter from the query parameters
+def get_business_query(args):
+    query = {} #An empty query matches every business
+    if args.get('town'): #Filters by town if 'town' is provided
+        query["town"] = args.get('town')
+
+    min_rating, max_rating = get_int_arg(args, 'min_rating', None), get_int_arg(args, 'max_rating', None)
+    for rating in (min_rating, max_rating): #Checks the ratings are in range, huge numbers can't be sent to the database
+        if rating is not None and to_score(rating) is None:
+            raise ValueError("Rating must be from 1 to 5")
+    if min_rating is not None or max_rating is not None: #Filters by a range of ratings
+        query["rating"] = {}
+        if min_rating is not None:
+            query["rating"]["$gte"] = min_rating
+        if max_rating is not None:
+            query["rating"]["$lte"] = max_rating
+
+    if args.get('name'): #Filters by the start of the name, an anchored regex can use an index
+        query["name"] = {"$regex" : "^" + re.escape(args.get('name'))}
+    return query
+
+'''
+This function reads the sort order from the 'sort' query parameter, which is a sort field with a
+'-' in front to sort in descending order. It returns the field and the direction, or None if the
+field can't be sorted by
+'''
+#Reads the sort field and direction
+def get_sort(args):
+    sort = args.get('sort', "_id") #Sort order from 'sort', defaults to '_id'
+    field = sort[1:] if sort.startswith("-") else sort #Removes the '-' from the field
+    if field not in SORT_FIELDS:
+        return None
+    return field, -1 if sort.startswith("-") else 1
+
+'''
+This function reads every query parameter of the list of businesses. It returns an error message
+and None if a parameter isn't valid, otherwise None and the options: the page number and size,
+the projection, the IDs if only some businesses are asked for, the filter, the sort and the
+'after' token if cursor pagination is used
+'''
+#Reads the options of the list of businesses
+def get_list_options(args):
+    #Values for pagination
+    try:
+        page_num = get_int_arg(args, 'pn', 1) #Page number from 'pn', defaults to 1
+        page_size = get_int_arg(args, 'ps', 10) #Page size from 'ps', defaults to 10
+    except ValueError: #If 'pn' or 'ps' isn't a whole number
+        return "Invalid page number or size", None
+
+    #Checks the page number and size are in range
+    if page_num < 1 or page_num > MAX_PAGE_NUM: #Stops negative pages and skips too big for the database
+        return "Page number must be between 1 and " + str(MAX_PAGE_NUM), None
+    if page_size < 1 or page_size > MAX_PAGE_SIZE: #Stops unbounded or negative pages
+        return "Page size must be between 1 and " + str(MAX_PAGE_SIZE), None
+
+    #Builds the projection, the list view only returns a summary by default
+    projection = get_projection(args, SUMMARY_FIELDS)
+    if projection is None: #If an unknown field was asked for
+        return "Invalid fields", None
+    options = {"page_num" : page_num, "page_size" : page_size, "projection" : projection,
+               "ids" : args.get('ids').split(",") if args.get('ids') else None}
+
+    #Builds the filter and the sort order
+    try:
+        options["query"] = get_business_query(args)
+    except ValueError: #If a rating isn't a whole number
+        return "Invalid rating", None
+    options["sort"] = get_sort(args)
+    if options["sort"] is None: #If the sort field can't be sorted by
+        return "Invalid sort field", None
+    field, direction = options["sort"]
+    options["sort_order"] = [(field, direction)] if field == "_id" else [(field, direction), ("_id", direction)]
+
+    #Cursor pagination is used if 'after' is provided, an empty 'after' starts from the first page
+    options["after"] = args.get('after')
+    return None, options
+
+#Checks the IDs of a batch read, returns an error message or None if they are valid
+def check_ids(ids):
+    if len(ids) > MAX_PAGE_SIZE:
+        return "No more than " + str(MAX_PAGE_SIZE) + " IDs can be given"
+    if not all(is_valid_objectid(id) for id in ids):
+        return "Invalid business ID"
+    return None
+
+#Returns the businesses in the order of their IDs, with None for any ID that wasn't found
+def order_by_ids(ids, businesses):
+    found = {str(business["_id"]) : business for business in businesses} #Business ID to business
+    return [found.get(id.lower()) for id in ids]
+
+#Reads the number and town of the top businesses, returns an error message and None if they aren't valid
+def get_top_options(args):
+    try:
+        count = get_int_arg(args, 'n', 10) #Number of businesses from 'n', defaults to 10
+    except ValueError: #If 'n' isn't a whole number
+        return "Invalid number of businesses", None
+    if count < 1 or count > MAX_PAGE_SIZE: #Checks the number is in range
+        return "n must be between 1 and " + str(MAX_PAGE_SIZE), None
+    query = {"town" : args.get('town')} if args.get('town') else {} #Filters by town if 'town' is provided
+    return None, {"count" : count, "query" : query, "projection" : dict.fromkeys(SUMMARY_FIELDS, 1)}
+
+#Reads the offset and limit of a page of reviews, returns an error message and None if they aren't valid
+def get_review_page(args):
+    try:
+        offset = get_int_arg(args, 'offset', 0) #Number of reviews to skip, defaults to 0
+        limit = get_int_arg(args, 'limit', 10) #Number of reviews to return, defaults to 10
+    except ValueError: #If 'offset' or 'limit' isn't a whole number
+        return "Invalid offset or limit", None
+    if offset < 0 or offset > MAX_REVIEW_OFFSET: #Checks the offset is in range, so clients can't cache endless pages
+        return "Offset must be between 0 and " + str(MAX_REVIEW_OFFSET), None
+    if limit < 1 or limit > MAX_PAGE_SIZE: #Checks the limit is in range
+        return "Limit must be between 1 and " + str(MAX_PAGE_SIZE), None
+    return None, (offset, limit)
+
+'''
+These functions check that a query can use an index. The first time a query shape (the fields it
+filters on and its sort order) is seen, its plan is checked with explain() by the app and stored,
+so no request can start a collection scan by accident. The shape leaves out the values and the
+operators, which can come from the client, so clients can't make new shapes and there are only
+as many as the filters and sorts the API offers. The plan is asked for with 'queryPlanner'
+verbosity, so the database chooses a plan without running the query to the end. A plan that walks
+a whole index and filters each document it fetches reads every document just like a collection
+scan, so it is caught as well. A whole index scan without a filter is allowed, it only gives the
+sort order and stops once the page is full
+'''
+#Returns the names of the fields a query filters on, leaving out its operators and values
+def query_fields(query):
+    fields = set()
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if not key.startswith("$"): #If the key is a field rather than an operator
+                fields.add(key)
+            fields |= query_fields(value)
+    elif isinstance(query, list):
+        for value in query:
+            fields |= query_fields(value)
+    return fields
+
+#Key for the shape of a query and its sort order
+def plan_key(query, sort_order):
+    return json.dumps([sorted(query_fields(query)), sort_order])
+
+#Command that asks the database which plan it would use for a find, without running the query
+def explain_command(collection, query, projection, sort_order):
+    return {"explain" : {"find" : collection, "filter" : query, "projection" : projection, "sort" : dict(sort_order)},
+            "verbosity" : "queryPlanner"}
+
+#Checks if a query plan scans the whole collection
+def uses_collection_scan(plan):
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(uses_collection_scan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(uses_collection_scan(value) for value in plan)
+    return False
+
+#Checks if a query plan scans every key of an index, in either direction
+def uses_whole_index_scan(plan):
+    if isinstance(plan, dict):
+        bounds = plan.get("indexBounds") if plan.get("stage") == "IXSCAN" else None
+        if bounds and all(ranges in (["[MinKey, MaxKey]"], ["[MaxKey, MinKey]"]) for ranges in bounds.values()):
+            return True
+        return any(uses_whole_index_scan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(uses_whole_index_scan(value) for value in plan)
+    return False
+
+#Checks if a query plan reads every document, by scanning the collection or a whole index for a filtered query
+def reads_every_document(plan, query):
+    return uses_collection_scan(plan) or bool(query) and uses_whole_index_scan(plan)
+
+#Whether each query shape can be run, found from its plan the first time the shape is seen
+class QueryPlans:
+    def __init__(self, max_shapes = 1000):
+        self.max_shapes = max_shapes #Most shapes kept, the oldest is checked again if it is seen after being dropped
+        self.allowed = {} #Query shape to whether it can be run, oldest first
+        self.lock = threading.Lock() #Stops threads changing the shapes at the same time
+
+    #Returns whether a query shape can be run, or None if its plan hasn't been checked yet
+    def allows(self, shape):
+        allowed = self.allowed.get(shape)
+        return allowed if allowed is None else allowed or not config.REJECT_COLLECTION_SCANS
+
+    '''
+    This function stores whether a query shape can be run from its plan, logging plans that read
+    every document, and returns whether it can be run. Queries that read every document are
+    rejected if REJECT_COLLECTION_SCANS is set
+    '''
+    #Checks the plan of a query shape
+    def check(self, shape, plan, query):
+        allowed = not reads_every_document(plan, query)
+        with self.lock:
+            while len(self.allowed) >= self.max_shapes: #Drops the oldest shape to stay within the limit
+                del self.allowed[next(iter(self.allowed))]
+            self.allowed[shape] = allowed
+        if not allowed:
+            logger.warning("Query reads every document: %s plan: %s", shape, json.dumps(plan, default = str))
+        return allowed or not config.REJECT_COLLECTION_SCANS
+
+'''
+These functions build and read the opaque 'next' token used by cursor pagination. The token holds
+the sort order, the sort value of the last business on the page and its ID, encoded as URL safe
+base64 JSON so clients treat it as a string. Decoding returns None if the token has been changed
+or doesn't match the requested sort order. The token comes from the client, so the sort value must
+be a plain value of the sort field's type, or a query operator could be put in the filter
+'''
+#Creates a cursor token from the last business on a page
+def encode_cursor(sort, business):
+    field, direction = sort
+    position = {"s" : field, "d" : direction, "id" : str(business["_id"])} #Stores the sort order and business ID
+    if field != "_id": #If the page is sorted by another field
+        position["v"] = business.get(field) #Stores the sort value of the last business
+    token = base64.urlsafe_b64encode(json.dumps(position).encode()) #Encodes the position as base64
+    return token.decode().rstrip("=") #Removes the padding so the token is URL friendly
+
+#Reads a cursor token back into a sort value and business ID
+def decode_cursor(token, sort):
+    try:
+        padded = token + "=" * (-len(token) % 4) #Adds back the base64 padding
+        position = json.loads(base64.urlsafe_b64decode(padded)) #Decodes the JSON position
+        if (position["s"], position["d"]) != sort or not is_valid_objectid(position["id"]): #Checks the token matches
+            return None
+        value = position.get("v") if sort[0] != "_id" else None
+        if not is_sort_value(sort[0], value): #If the sort value isn't one a business could have
+            return None
+        return value, ObjectId(position["id"]) #Returns the sort value and the business ID
+    except (ValueError, TypeError, KeyError, RecursionError): #If the token isn't valid base64 or JSON
+        return None
+
+#Checks a sort value from a cursor token is None or a value of the sort field's type that BSON can encode
+def is_sort_value(field, value):
+    if value is None or field == "_id":
+        return value is None
+    if isinstance(value, bool) or not isinstance(value, SORT_VALUE_TYPES[field]):
+        return False
+    return not isinstance(value, int) or -2 ** 63 <= value < 2 ** 63 #Larger integers don't fit in 64 bits
+
+'''
+This function adds to a query a filter that seeks past the last business of the previous page,
+using the sort field and '_id' so it can be answered from an index. None is returned if the
+token isn't valid, an empty token leaves the query as it is so the first page is returned
+'''
+#Adds the filter for the page after a cursor token
+def seek_after(query, token, sort):
+    if not token: #If no token is provided the first page is returned
+        return query
+    position = decode_cursor(token, sort) #Reads the sort value and ID from the token
+    if position is None:
+        return None
+    field, direction = sort
+    last_value, last_id = position
+    past = "$gt" if direction == 1 else "$lt" #Operator for values after the last one in this direction
+    if field == "_id": #Sorting by ID only needs the ID
+        seek = {"_id" : {past : last_id}}
+    else: #Otherwise businesses with the same value are ordered by ID
+        seek = {"$or" : [
+            {field : {past : last_value}},
+            {field : last_value, "_id" : {past : last_id}}
+        ]}
+    return {"$and" : [query, seek]} if query else seek
+
+'''
+These build a page of cursor pagination. The query seeks past the token and the projection
+includes the sort field so the next token can be made. One more business than the page size is
+asked for, and the page passes on the businesses until it sees the extra one, which means there
+is another page, and then makes the 'next' token from the last business on the page
+'''
+#Returns the query and projection of the page after a token, or None if the token isn't valid
+def cursor_page_query(query, projection, token, sort):
+    query = seek_after(query, token, sort) #Adds the filter that seeks past the last business of the previous page
+    if query is None:
+        return None
+    return query, dict(projection, **{sort[0] : 1}) #Includes the sort field so the token can be made
+
+#A page of businesses that makes the token for the next page
+class CursorPage:
+    before = '{"businesses":' #Text sent before the businesses
+
+    def __init__(self, page_size, sort):
+        self.page_size, self.sort = page_size, sort
+        self.count, self.last, self.next = 0, None, None
+
+    #Adds a business read from the cursor, returns False if it is the extra one and the page is done
+    def add(self, business):
+        if self.count == self.page_size: #If the extra business was returned
+            self.next = encode_cursor(self.sort, self.last) #Creates the token from the last business on the page
+            return False
+        self.count, self.last = self.count + 1, business
+        return True
+
+    #Text sent after the businesses, with the token for the next page
+    def after(self):
+        return ',"next":' + json.dumps(self.next) + "}"
@@ -0,0 +1,49 @@
+'''
+This holds the settings shared by the Flask app in app.py and the asyncio app in async_app.py.
+Each setting can be changed with an environment variable of the same name, so the same code can
+be pointed at another database or given bigger pools without editing it. The pool settings are
+per process, so with serve.py the database sees up to workers x MONGO_MAX_POOL_SIZE connections.
+'''
+
+#Imports the module to read environment variables
+import os
+
+#Database connection
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://127.0.0.1:27017")
+MONGO_DB = os.environ.get("MONGO_DB", "dizDB")
+MONGO_COLLECTION = os.environ.get("MONGO_COLLECTION", "biz")
+
+#Connection pool, per process
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)) #Most connections open to the database at once
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000)) #Time allowed to open a connection
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)) #Time allowed to find a server
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)) #Time a request waits for a free connection
+HEALTH_CHECK_TIMEOUT_MS = int(os.environ.get("HEALTH_CHECK_TIMEOUT_MS", 1000)) #Time the readiness check allows for a ping
+
+#Checks each cached response against the version of the business in the database before it is used. Every process
+#has its own cache and only sees its own writes, so this must be on when more than one process serves the API.
+#serve.py turns it on when it has more than one worker, with uvicorn --workers or any other server with several
+#workers set CACHE_REVALIDATE=1. It is off for a single process, so a 304 from the cache needs no database round trip
+CACHE_REVALIDATE = os.environ.get("CACHE_REVALIDATE", "0") == "1"
+
+#Rejects list queries that would read every document, with a 400, otherwise they are only logged
+REJECT_COLLECTION_SCANS = os.environ.get("REJECT_COLLECTION_SCANS", "1") == "1"
+
+#Largest number of requests the asyncio app handles at once, the rest wait their turn
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASYNC_MAX_CONCURRENCY", 1000))
+
+#Write-behind review queue, off unless REVIEW_WRITE_BEHIND is 1. Only the Flask app has the queue, the asyncio app
+#always writes reviews straight away and logs a warning if it is turned on
+REVIEW_WRITE_BEHIND = os.environ.get("REVIEW_WRITE_BEHIND", "0") == "1" #Queues new reviews and writes them in batches
+REVIEW_FLUSH_INTERVAL = float(os.environ.get("REVIEW_FLUSH_INTERVAL", 0.1)) #Seconds between writes of the queued reviews
+REVIEW_QUEUE_MAX = int(os.environ.get("REVIEW_QUEUE_MAX", 10000)) #Most reviews waiting at once, more are turned away with a 503
+REVIEW_FLUSH_ATTEMPTS = int(os.environ.get("REVIEW_FLUSH_ATTEMPTS", 5)) #Times a batch is written before its reviews are dropped
+
+#Options passed to MongoClient and AsyncMongoClient
+def client_options():
+    return {
+        "maxPoolSize" : MONGO_MAX_POOL_SIZE,
+        "connectTimeoutMS" : MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS" : MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "waitQueueTimeoutMS" : MONGO_WAIT_QUEUE_TIMEOUT_MS
+    }
@@ -0,0 +1,135 @@
+'''
+This loads an NDJSON file of businesses, such as one made by make_json.py, into the database.
+
+The file is split into byte ranges, one for each worker process. Each worker reads its range
+line by line and inserts the businesses in batches with an unordered insert_many, so memory use
+only depends on the batch size. After every batch a worker saves how far it has got in the
+checkpoint folder, so a load that is stopped can be started again with the same arguments and
+carry on. Businesses carry their own IDs, so any batch inserted again after a restart only causes
+duplicate key errors, which are ignored. The number of documents loaded per second is reported
+as the load runs.
+
+Usage: python load_data.py data.ndjson [--workers N] [--batch-size N] [--checkpoint DIR] [--restart]
+'''
+
+#Imports the modules to read arguments, run worker processes, store checkpoints and connect to the database
+import argparse, json, multiprocessing, os, time
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000 #Error code for a document that was already inserted
+
+#Turns {"$oid": ...} back into an ObjectId while the JSON is decoded
+def decode_id(document):
+    if len(document) == 1 and "$oid" in document:
+        return ObjectId(document["$oid"])
+    return document
+
+#Inserts a batch, returns how many were inserted and ignores businesses that already exist
+def insert_batch(collection, batch):
+    try:
+        return len(collection.insert_many(batch, ordered = False).inserted_ids)
+    except BulkWriteError as error:
+        if any(write_error["code"] != DUPLICATE_KEY for write_error in error.details["writeErrors"]):
+            raise #Raises any error that isn't a duplicate
+        return error.details["nInserted"]
+
+#Reads the checkpoint of a worker, or None if there isn't one
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        return json.load(fin)
+
+#Saves the checkpoint of a worker, replacing the file so a crash can't leave half of it
+def write_checkpoint(path, checkpoint):
+    with open(path + ".tmp", "w") as fout:
+        json.dump(checkpoint, fout)
+    os.replace(path + ".tmp", path)
+
+#Loads the lines that start in one byte range of the file
+def load_range(args, worker, start, end, loaded):
+    collection = MongoClient(args.uri)[args.db][args.collection] #Each process makes its own client
+    checkpoint_path = os.path.join(args.checkpoint, "worker-%d.json" % worker)
+    checkpoint = read_checkpoint(checkpoint_path)
+    offset = checkpoint["offset"] if checkpoint else start #Carries on from the checkpoint if there is one
+
+    with open(args.path, "rb") as fin:
+        fin.seek(offset)
+        if offset == start and start > 0: #Skips the line that started in the previous range
+            fin.seek(start - 1)
+            fin.readline()
+            offset = fin.tell()
+
+        batch = []
+        while offset < end: #Reads every line that starts in this range
+            line = fin.readline()
+            if not line:
+                break
+            offset += len(line)
+            if line.strip():
+                batch.append(json.loads(line, object_hook = decode_id))
+            if len(batch) >= args.batch_size or offset >= end: #Inserts a full batch, or the last one
+                if batch:
+                    inserted = insert_batch(collection, batch)
+                    with loaded.get_lock():
+                        loaded.value += inserted
+                batch = []
+                write_checkpoint(checkpoint_path, {"start" : start, "end" : end, "offset" : offset})
+
+#Splits the file into one byte range per worker
+def split_ranges(path, workers):
+    size = os.path.getsize(path)
+    step = -(-size // workers) #Rounds up so the ranges cover the whole file
+    return [(i * step, min(size, (i + 1) * step)) for i in range(workers)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Loads an NDJSON file of businesses into the database")
+    parser.add_argument("path", help = "NDJSON file to load")
+    parser.add_argument("--uri", default = "mongodb://127.0.0.1:27017")
+    parser.add_argument("--db", default = "dizDB")
+    parser.add_argument("--collection", default = "biz")
+    parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "number of worker processes")
+    parser.add_argument("--batch-size", type = int, default = 1000, help = "businesses per insert_many")
+    parser.add_argument("--checkpoint", help = "folder for checkpoints, defaults to <path>.checkpoint")
+    parser.add_argument("--restart", action = "store_true", help = "ignore any checkpoints and load from the start")
+    args = parser.parse_args()
+    args.checkpoint = args.checkpoint or args.path + ".checkpoint"
+
+    #Checks the checkpoints were made with the same number of workers, so the ranges match
+    os.makedirs(args.checkpoint, exist_ok = True)
+    ranges = split_ranges(args.path, args.workers)
+    for worker, (start, end) in enumerate(ranges):
+        checkpoint_path = os.path.join(args.checkpoint, "worker-%d.json" % worker)
+        checkpoint = read_checkpoint(checkpoint_path)
+        if args.restart and checkpoint:
+            os.remove(checkpoint_path)
+        elif checkpoint and (checkpoint["start"], checkpoint["end"]) != (start, end):
+            parser.error("the checkpoints in %s were made with a different number of workers, "
+                         "use the same --workers or --restart" % args.checkpoint)
+
+    #Starts one process for each byte range
+    loaded = multiprocessing.Value("q", 0) #Businesses inserted by all the workers
+    processes = [
+        multiprocessing.Process(target = load_range, args = (args, worker, start, end, loaded))
+        for worker, (start, end) in enumerate(ranges)
+    ]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+
+    #Reports the progress every 5 seconds until every worker has finished
+    reported = started
+    while any(process.is_alive() for process in processes):
+        time.sleep(0.5)
+        if time.perf_counter() - reported >= 5:
+            reported = time.perf_counter()
+            print("%d businesses loaded, %.0f docs/sec" % (loaded.value, loaded.value / (reported - started)), flush = True)
+    for process in processes:
+        process.join()
+
+    seconds = time.perf_counter() - started
+    print("Loaded %d businesses in %.1f seconds, %.0f docs/sec" % (loaded.value, seconds, loaded.value / seconds))
+    if any(process.exitcode != 0 for process in processes):
+        raise SystemExit("A worker failed, run the same command again to carry on from the checkpoints")
@@ -1,45 +1,91 @@
 '''
-This will generate a 100 dummy business data which includes names, towns and ratings 
-and saves it to a JSON file names 'data.json'
+This will generate dummy business data which includes names, towns, ratings and reviews and
+saves it to a newline delimited JSON (NDJSON) file, one business per line, which can be loaded
+with load_data.py
 
-It imports modules, defines a function to create the dummy data and includes
-the code to write the data to a JSON file
+Businesses are generated one at a time and written straight to the file, so memory use stays the
+same whether 100 or tens of millions of businesses are made. The number of reviews per business
+follows a long tailed (Pareto) distribution, so most businesses have a few reviews and a small
+number have thousands. IDs are written as {"$oid": ...} so the loader can store them as ObjectIds.
+The IDs come from the same random numbers as the rest of the data, so a run with --seed always
+writes the same file
+
+Usage: python make_json.py [--count N] [--out data.ndjson] [--seed N] [--max-reviews N] [--alpha A]
 '''
 
-#Imports the 2 modules to generate random numbers and to work with JSON data
-import random, json
-
-#Function to generate dummy data
-def generate_dummy_data(): #Defines function
-    #Lists of towns 
-    towns = [
-        'Coleraine', 'Banbridge', 'Belfast', 'Lisburn', 
-        'Ballymena', 'Derry', 'Newry', 'Enniskillen',
-        'Omagh', 'Ballymoney'
-    ] #List of town names assigned to 'towns'
-
-    #List to store business data 
-    business_list = [] #Empty list is assigned to 'business_list'
-
-    #Generates 100 dummy business entries
-    for i in range(100): 
-        name = "Biz " + str(i) #Generates the business name e.g. 'Biz 0'
-        town = towns[random.randint (0, len(towns) - 1) ] #Randomly selects a town from 'towns'
-        rating = random.randint(1, 5) #Randomly assigns a rating between 1 and 5
-        
-        #Adds business data to 'business_list'
-        business_list.append( {
-            "name": name, "town": town, 
-            "rating": rating, "reviews": []
-        } ) 
-
-    #Returns the generated list of businesses
-    return business_list #Output: the created list of business entries
-
-#Generates the dummy data
-business = generate_dummy_data() #Calls the function to create a list of dummy data
-
-#Writes the data to a JSON file named 'data.json'
-fout = open("data.json", "w") #Opens the file in write mode
-fout.write(json.dumps (business) ) #Converts the list to a JSON string and writes it to the file 
-fout.close() #Closes the file
\ No newline at end of file
+#Imports the modules to read arguments, generate random numbers, IDs and JSON data
+import argparse, json, random, sys, time
+from bson import ObjectId
+
+#Lists of towns, the larger towns are listed more than once so they get more businesses
+towns = [
+    'Coleraine', 'Banbridge', 'Belfast', 'Lisburn',
+    'Ballymena', 'Derry', 'Newry', 'Enniskillen',
+    'Omagh', 'Ballymoney', 'Belfast', 'Belfast', 'Derry'
+] #List of town names assigned to 'towns'
+
+#Lists of words used to make review comments
+openings = ["Great", "Decent", "Terrible", "Lovely", "Average", "Friendly", "Slow", "Excellent"]
+subjects = ["service", "food", "staff", "value", "atmosphere", "location", "prices"]
+endings = ["would come again.", "not for me.", "highly recommended.", "could be better.", "okay overall."]
+
+#Encodes ObjectIds in the extended JSON form read by the loader
+def encode_id(value):
+    if isinstance(value, ObjectId):
+        return {"$oid" : str(value)}
+    raise TypeError("Can't encode " + type(value).__name__)
+
+#Generates an ObjectId from the random numbers, so a seeded run gives the same IDs
+def generate_id():
+    return ObjectId(random.randbytes(12))
+
+#Function to generate one review, stars are spread around the business's quality
+def generate_review(quality):
+    stars = min(5, max(1, round(random.gauss(quality, 1)))) #Keeps the stars between 1 and 5
+    return {
+        "_id" : generate_id(), #Generates a new ObjectId for the review
+        "username" : "user" + str(random.randint(1, 1000000)),
+        "comment" : " ".join([random.choice(openings), random.choice(subjects) + ",", random.choice(endings)]),
+        "stars" : stars
+    }
+
+#Function to generate businesses one at a time
+def generate_businesses(count, max_reviews, alpha): #Defines generator
+    for i in range(count):
+        quality = random.uniform(1, 5) #How good the business is, its reviews and rating follow this
+        review_count = min(int(random.paretovariate(alpha)) - 1, max_reviews) #Long tailed number of reviews
+        reviews = [generate_review(quality) for _ in range(review_count)]
+        star_sum = sum(review["stars"] for review in reviews)
+
+        #Yields the business with its review aggregates already worked out
+        yield {
+            "_id" : generate_id(), #Generates the business ID so the load can be resumed without duplicates
+            "name" : "Biz " + str(i), #Generates the business name e.g. 'Biz 0'
+            "town" : random.choice(towns), #Randomly selects a town from 'towns'
+            "rating" : min(5, max(1, round(quality))), #Rating between 1 and 5 close to the quality
+            "reviews" : reviews,
+            "review_count" : review_count, "star_sum" : star_sum,
+            "avg_stars" : star_sum / review_count if review_count else None,
+            "version" : 0
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generates dummy businesses as NDJSON")
+    parser.add_argument("--count", type = int, default = 100, help = "number of businesses")
+    parser.add_argument("--out", default = "data.ndjson", help = "file to write, '-' for stdout")
+    parser.add_argument("--seed", type = int, help = "random seed, for repeatable data")
+    parser.add_argument("--max-reviews", type = int, default = 5000, help = "most reviews a business can have")
+    parser.add_argument("--alpha", type = float, default = 1.2, help = "Pareto shape, smaller gives a longer tail")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    #Writes each business to the file as it is generated
+    start = time.perf_counter()
+    fout = sys.stdout if args.out == "-" else open(args.out, "w", buffering = 1 << 20) #Opens the file in write mode
+    for business in generate_businesses(args.count, args.max_reviews, args.alpha):
+        fout.write(json.dumps(business, default = encode_id, separators = (",", ":")) + "\n")
+    if fout is not sys.stdout:
+        fout.close() #Closes the file
+
+    print("Generated %d businesses in %.1f seconds" % (args.count, time.perf_counter() - start), file = sys.stderr)
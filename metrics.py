@@ -0,0 +1,190 @@
+'''
+This measures where request time goes. A pymongo command listener counts the database commands,
+documents returned and time of each request, and simple counters and histograms collect them per route so
+they can be published in the Prometheus text format.
+
+The listener keeps its totals in a context variable. pymongo sends the events on the thread, or
+in the asyncio task, that ran the command, and each request is handled on its own thread by the
+Flask app and in its own task by the asyncio app, so the totals belong to the current request.
+
+Documents are counted from the length of the batches in each reply rather than by encoding the
+reply again to measure its bytes, which would double the work of reading a business with a large
+reviews array.
+'''
+
+#Imports the modules to listen to database commands and connections and lock the metrics
+from pymongo import monitoring
+import contextvars, threading
+
+#Command listener that adds up the database work of the current request
+class CommandTimer(monitoring.CommandListener):
+    def __init__(self):
+        self.current = contextvars.ContextVar("command_totals", default = None) #Totals for the request on each thread or task
+
+    #Starts new totals, called at the start of each request
+    def reset(self):
+        self.current.set({"commands" : 0, "documents" : 0, "seconds" : 0.0})
+
+    #Returns the totals of the current request
+    def totals(self):
+        return self.current.get() or {"commands" : 0, "documents" : 0, "seconds" : 0.0}
+
+    #Adds to the totals of the current request, if it has any
+    def add(self, commands, documents, seconds):
+        totals = self.current.get()
+        if totals is not None: #Commands outside a request, like creating indexes, aren't counted
+            totals["commands"] += commands
+            totals["documents"] += documents
+            totals["seconds"] += seconds
+
+    def started(self, event):
+        self.add(1, 0, 0) #Counts the command
+
+    def succeeded(self, event):
+        self.add(0, reply_documents(event.reply), event.duration_micros / 1e6) #Counts the documents returned
+
+    def failed(self, event):
+        self.add(0, 0, event.duration_micros / 1e6)
+
+#Returns the number of documents in a command reply, from its cursor batch or a findAndModify value
+def reply_documents(reply):
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    return 1 if reply.get("value") else 0
+
+#Connection pool listener that counts the open and checked out connections of this process
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.open, self.in_use = 0, 0
+        self.lock = threading.Lock()
+
+    def change(self, open, in_use):
+        with self.lock:
+            self.open += open
+            self.in_use += in_use
+
+    def connection_created(self, event):
+        self.change(1, 0)
+
+    def connection_closed(self, event):
+        self.change(-1, 0)
+
+    def connection_checked_out(self, event):
+        self.change(0, 1)
+
+    def connection_checked_in(self, event):
+        self.change(0, -1)
+
+    #Events that don't change the counts
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+
+#Formats the labels of a metric, e.g. {route="/",method="GET"}
+def format_labels(names, values, extra = ""):
+    pairs = ['%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+#Counter that only goes up, kept for each set of label values
+class Counter:
+    def __init__(self, name, help, labels = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values = (), amount = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+#Histogram of observed values with cumulative buckets, kept for each set of label values
+class Histogram:
+    def __init__(self, name, help, labels = (), buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {} #Label values to [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self.lock:
+            counts, total, count = self.values.get(label_values) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets): #Counts the value in every bucket it fits in
+                if value <= bound:
+                    counts[i] += 1
+            self.values[label_values] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = format_labels(self.labels, label_values, 'le="%s"' % bound)
+                    lines.append("%s_bucket%s %d" % (self.name, labels, bucket_count))
+                labels = format_labels(self.labels, label_values, 'le="+Inf"')
+                lines.append("%s_bucket%s %d" % (self.name, labels, count))
+                lines.append("%s_sum%s %s" % (self.name, format_labels(self.labels, label_values), total))
+                lines.append("%s_count%s %d" % (self.name, format_labels(self.labels, label_values), count))
+        return lines
+
+#Metric whose value is read from a function when the metrics are rendered
+class Sampled:
+    def __init__(self, name, help, type, read):
+        self.name, self.help, self.type, self.read = name, help, type, read
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type),
+                "%s %s" % (self.name, self.read())]
+
+#Renders metrics in the Prometheus text format
+def render(metrics):
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+'''
+These are the request and cache metrics published by both apps at /metrics. Requests are labelled
+by their route and method, and recorded once their body has been sent
+'''
+#Time and database work of requests, labelled by route and method
+class RequestMetrics:
+    def __init__(self, labels):
+        self.seconds = Histogram("http_request_duration_seconds", "Time to handle a request and send its body", labels + ("status",))
+        self.commands = Counter("mongo_commands_total", "Database commands run by requests", labels)
+        self.db_seconds = Counter("mongo_command_seconds_total", "Time spent waiting for database commands", labels)
+        self.documents = Counter("mongo_documents_returned_total", "Documents returned by database commands", labels)
+        self.metrics = [self.seconds, self.commands, self.db_seconds, self.documents]
+
+    #Records a request from its time and the database totals of the command listener
+    def record(self, label_values, status, seconds, totals):
+        self.seconds.observe(label_values + (status,), seconds)
+        self.commands.inc(label_values, totals["commands"])
+        self.db_seconds.inc(label_values, totals["seconds"])
+        self.documents.inc(label_values, totals["documents"])
+
+#Formats the Server-Timing header from the database totals and the request time, in milliseconds
+def server_timing(totals, seconds):
+    return 'db;dur=%.2f;desc="%d commands, %d documents", app;dur=%.2f' % (
+        totals["seconds"] * 1000, totals["commands"], totals["documents"], seconds * 1000)
+
+#Metrics read from a response cache
+def cache_metrics(cache):
+    return [
+        Sampled("response_cache_hits_total", "Response cache hits", "counter", lambda: cache.hits),
+        Sampled("response_cache_misses_total", "Response cache misses", "counter", lambda: cache.misses),
+        Sampled("response_cache_evictions_total", "Views evicted from the response cache", "counter", lambda: cache.evictions),
+        Sampled("response_cache_entries", "Views in the response cache", "gauge", lambda: len(cache.entries)),
+        Sampled("response_cache_bytes", "Size of the responses in the response cache", "gauge", lambda: cache.size)
+    ]
@@ -0,0 +1,164 @@
+'''
+This is an in-process write-behind queue for new reviews. During a burst of reviews, updating a
+business once per review makes every update wait on the others and rewrite its growing reviews
+array each time. Instead, reviews are held per business and a background thread writes them
+every flush interval, with one update per business that adds all of its waiting reviews and their
+aggregates, sent together in a single unordered bulk_write.
+
+The queue holds at most 'max_pending' reviews. When it is full, add() returns False so the route
+can ask the client to retry later. The thread is started by the first review, so a process that
+is forked after the app is imported starts its own. Waiting reviews are written when the queue is
+stopped, which happens when the process exits.
+
+A queued review has already been accepted, so a write that fails because the database couldn't be
+reached is queued again and retried, up to 'max_attempts' times. Every update only matches a
+business that doesn't have the first review of its batch yet, so a retry of a write that was
+applied before the error matches nothing instead of adding the reviews twice. The route checks the
+business exists before queueing, so unmatched updates are retries or businesses deleted since.
+'''
+
+#Imports the modules to run the flusher thread, build the updates and time the flushes
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from bson import ObjectId
+from aggregates import add_reviews_update
+from metrics import Counter, Histogram, Sampled
+import atexit, logging, threading, time
+
+logger = logging.getLogger(__name__)
+
+#Queue of reviews waiting to be written, grouped by business ID
+class ReviewQueue:
+    def __init__(self, get_collection, max_pending, interval, on_written = None, max_attempts = 5):
+        self.get_collection = get_collection #Returns the collection to write to
+        self.max_pending = max_pending #Largest number of reviews waiting at once
+        self.interval = interval #Seconds between flushes
+        self.on_written = on_written #Called with the ID of each business after its reviews are written
+        self.max_attempts = max_attempts #Most times a batch is written before its reviews are dropped
+        self.pending = {} #Business ID to its waiting reviews, in the order they arrived
+        self.retries = [] #Business ID, reviews and attempts so far of each batch whose write failed
+        self.size = 0 #Number of waiting reviews, including those waiting to be retried
+        self.lock = threading.Lock() #Stops threads changing the waiting reviews at the same time
+        self.flush_lock = threading.Lock() #Stops two flushes running at once
+        self.stopping = threading.Event()
+        self.thread = None
+
+        #Metrics for /metrics
+        self.batch_reviews = Histogram("review_queue_batch_reviews", "Reviews written by one flush", (),
+                                       (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+        self.batch_businesses = Histogram("review_queue_batch_businesses", "Businesses updated by one flush", (),
+                                          (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+        self.flush_seconds = Histogram("review_queue_flush_seconds", "Time taken by one flush")
+        self.written = Counter("review_queue_written_total", "Reviews written by the queue")
+        self.rejected = Counter("review_queue_rejected_total", "Reviews turned away because the queue was full")
+        self.unmatched = Counter("review_queue_unmatched_total",
+                                 "Updates by the queue that matched no business, because it was deleted or a retried write was already applied")
+        self.retried = Counter("review_queue_retried_total", "Reviews queued again after their write failed")
+        self.dropped = Counter("review_queue_dropped_total", "Reviews that failed to be written")
+        self.metrics = [self.batch_reviews, self.batch_businesses, self.flush_seconds, self.written, self.rejected,
+                        self.unmatched, self.retried, self.dropped,
+                        Sampled("review_queue_pending", "Reviews waiting to be written", "gauge", lambda: self.size)]
+
+    #Adds a review to the queue, returns False if the queue is full
+    def add(self, id, review):
+        with self.lock:
+            if self.size >= self.max_pending: #If the queue is full
+                self.rejected.inc()
+                return False
+            self.pending.setdefault(id, []).append(review)
+            self.size += 1
+            if self.thread is None: #Starts the flusher with the first review
+                self.thread = threading.Thread(target = self.run, name = "review-queue", daemon = True)
+                self.thread.start()
+                atexit.register(self.stop) #Writes the waiting reviews when the process exits
+        return True
+
+    #Flushes the queue every interval until it is stopped
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.flush()
+            except Exception: #Keeps the flusher running after an unexpected error
+                logger.exception("Review queue flush failed")
+
+    '''
+    This function writes every waiting review. The waiting reviews are swapped for an empty queue
+    so new reviews can be added while the write runs. Each business gets one update adding all of
+    its new reviews, each failed batch being retried gets one of its own, and the updates are sent
+    in one unordered bulk_write so a failed business doesn't stop the others. Updates the server
+    rejected would fail again, so their reviews are dropped. If the database couldn't be reached,
+    the write concern failed or the write raised anything else, the batches are queued again and
+    dropped once they have run out of attempts. The metrics and the cache are updated whatever
+    happened
+    '''
+    #Writes the waiting reviews
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                retries, self.retries = self.retries, []
+                batches = retries + [(id, reviews, 0) for id, reviews in self.pending.items()] #Retries first to keep the order
+                self.pending, count, self.size = {}, self.size, 0
+            if not batches:
+                return
+
+            start = time.perf_counter()
+            operations = [UpdateOne(batch_filter(id, reviews), add_reviews_update(reviews)) for id, reviews, attempts in batches]
+            again = set(range(len(batches))) #Positions of the batches to try again, all of them unless the write says otherwise
+            failed = set() #Positions of the batches that were dropped
+            try:
+                result = self.get_collection().bulk_write(operations, ordered = False)
+                again = set()
+                self.unmatched.inc((), len(operations) - result.matched_count)
+            except BulkWriteError as error:
+                #Updates the server rejected would fail again, the others are only retried if the write concern failed
+                failed = {write_error["index"] for write_error in error.details.get("writeErrors", [])}
+                again = again - failed if error.details.get("writeConcernErrors") else set()
+                self.unmatched.inc((), max(0, len(operations) - len(failed) - error.details.get("nMatched", 0)))
+                if failed:
+                    logger.error("Failed to write reviews for %d businesses: %s", len(failed), error.details["writeErrors"][0]["errmsg"])
+                if again:
+                    logger.error("Write concern failed for %d businesses, they will be retried: %s", len(again),
+                                 error.details["writeConcernErrors"][0].get("errmsg"))
+            except PyMongoError as error:
+                logger.error("Failed to write %d reviews, they will be retried: %s", count, error)
+            finally:
+                #Queues the batches to retry ahead of any reviews added since, dropping those out of attempts
+                retry = []
+                for index in sorted(again):
+                    id, reviews, attempts = batches[index]
+                    if attempts + 1 < self.max_attempts:
+                        retry.append((id, reviews, attempts + 1))
+                    else:
+                        failed.add(index)
+                retried = sum(len(reviews) for id, reviews, attempts in retry)
+                with self.lock:
+                    self.retries = retry
+                    self.size += retried
+                self.retried.inc((), retried)
+
+                #Records the flush and tells the app which businesses changed, even if the write raised
+                dropped = sum(len(batches[index][1]) for index in failed)
+                self.dropped.inc((), dropped)
+                self.written.inc((), count - dropped - retried)
+                self.batch_reviews.observe((), count)
+                self.batch_businesses.observe((), len(batches))
+                self.flush_seconds.observe((), time.perf_counter() - start)
+                if self.on_written:
+                    for id in {batch[0] for batch in batches}:
+                        self.on_written(id)
+
+    #Stops the flusher and writes whatever is still waiting
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception: #Runs at exit, where an error would only be printed without the count below
+            logger.exception("Review queue flush failed")
+        if self.size: #If the last write failed there is no later flush to retry it
+            logger.error("%d reviews were not written before the queue stopped", self.size)
+
+#Filter for the update adding a batch of reviews, matching the business only until the batch is added
+def batch_filter(id, reviews):
+    return {"_id" : ObjectId(id), "reviews._id" : {"$ne" : reviews[0]["_id"]}}
@@ -0,0 +1,217 @@
+'''
+This runs the app with several worker processes in place of app.run(). The master process opens
+the listening socket and forks the workers, which all accept connections from it, so requests are
+shared across every core. Each worker imports the app after the fork and serves it with Werkzeug's
+threaded server, and the app creates its database client the first time a worker uses it, so no
+connection pool is shared between processes.
+
+Werkzeug's server is a development server: it starts a thread for every request, has no limit on
+them and isn't hardened against slow or malicious clients, so it should sit behind a reverse
+proxy. app:app is a plain WSGI app that needs nothing from this script, so it can instead be run
+under a production WSGI server, e.g. gunicorn --workers N --bind 127.0.0.1:2000 app:app. Either
+way each worker has its own response cache, so with more than one worker this script turns on
+CACHE_REVALIDATE in config.py unless it is already set.
+
+The master restarts any worker that dies and handles these signals:
+
+    HUP          reload: starts new workers, which import the code again, then drains the old
+                 ones once the new ones are ready. If any new worker dies or isn't ready within
+                 --graceful-timeout, the new ones are stopped and the old ones keep serving
+    TERM, INT    stop: drains every worker, then exits
+
+A worker that is drained stops accepting connections, returns 503 from /readyz and finishes the
+requests it has already started before it exits, running the app's exit handlers such as the
+final flush of the review queue. Workers still running after --graceful-timeout are killed.
+
+Usage: python serve.py [--host 127.0.0.1] [--port 2000] [--workers N] [--app app:app] [--graceful-timeout 30]
+'''
+
+#Imports the modules to read arguments, fork the workers, open the socket and handle signals
+import argparse, importlib, logging, os, select, signal, socket, sys, threading, time
+from werkzeug.serving import make_server
+
+logger = logging.getLogger("serve")
+
+#Imports the WSGI app given as 'module:name'
+def load_app(spec):
+    module_name, _, name = spec.partition(":")
+    module = importlib.import_module(module_name)
+    return module, getattr(module, name or "app")
+
+'''
+This function runs in each worker after the fork. It serves the app on the shared socket until
+the worker is sent TERM. Werkzeug's server is made to keep track of its request threads, so
+closing it waits for the requests in progress to finish
+'''
+#Serves the app in a worker process, writing to 'ready' once it is accepting connections
+def run_worker(args, listener, ready):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl+C reaches every process, the master handles it
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    module, app = load_app(args.app)
+    if hasattr(module, "ensure_indexes"): #Makes sure the indexes exist before serving requests
+        try:
+            module.ensure_indexes()
+        except Exception as error: #The worker still starts, /readyz shows if the database can't be reached
+            logger.warning("Worker %d couldn't create the indexes: %s", os.getpid(), error)
+
+    server = make_server(args.host, args.port, app, threaded = True, fd = listener.fileno())
+    server.daemon_threads = False #Keeps the request threads so closing the server waits for them
+    try:
+        os.write(ready, b"1") #Tells the master this worker is ready
+    except OSError: #If the master isn't waiting for it
+        pass
+    os.close(ready)
+
+    #Stops accepting connections when TERM is received, shutdown() must run on another thread
+    def drain(signum, frame):
+        if hasattr(app, "config"): #Makes /readyz return 503
+            app.config["DRAINING"] = True
+        threading.Thread(target = server.shutdown).start()
+    signal.signal(signal.SIGTERM, drain)
+
+    logger.info("Worker %d serving on http://%s:%d", os.getpid(), args.host, args.port)
+    server.serve_forever()
+    server.server_close() #Waits for the requests in progress
+    logger.info("Worker %d stopped", os.getpid())
+
+'''
+This is the master process. It forks the workers and then waits, restarting workers that die and
+handling the signals it is sent. A worker is only restarted if it isn't being drained, and one
+that dies straight after starting is restarted after a pause so a broken app doesn't fork
+endlessly
+'''
+class Master:
+    def __init__(self, args, listener):
+        self.args, self.listener = args, listener
+        self.workers = {} #Process ID to the time the worker started
+        self.draining = {} #Process ID to the time the worker was told to stop
+        self.signals = [] #Signals received and not handled yet
+
+    #Forks a worker, returns a pipe that can be read once it is ready, the child never returns from here
+    def spawn(self):
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            try:
+                run_worker(self.args, self.listener, ready_write)
+            except Exception:
+                logger.exception("Worker %d failed", os.getpid())
+                sys.exit(1)
+            sys.exit(0) #Exits normally so the app's exit handlers run
+        os.close(ready_write)
+        self.workers[pid] = time.monotonic()
+        return ready_read
+
+    #Waits for every new worker to be ready for up to the graceful timeout, returns False if any died or is late
+    def wait_ready(self, pipes):
+        deadline = time.monotonic() + self.args.graceful_timeout
+        ready = True
+        while pipes and time.monotonic() < deadline:
+            readable, _, _ = select.select(pipes, [], [], max(0, deadline - time.monotonic()))
+            for pipe in readable: #Each pipe gets a byte when its worker is ready, or closes empty if it died
+                if os.read(pipe, 1) != b"1":
+                    ready = False
+                os.close(pipe)
+                pipes.remove(pipe)
+        for pipe in pipes: #Workers that weren't ready in time
+            os.close(pipe)
+        return ready and not pipes
+
+    #Tells a worker to finish its requests and stop
+    def drain(self, pid):
+        self.workers.pop(pid, None)
+        self.draining[pid] = time.monotonic()
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    #Collects workers that have exited, returns the ones that weren't meant to
+    def reap(self):
+        died = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError: #If there are no workers left
+                break
+            if pid == 0:
+                break
+            if pid in self.workers:
+                died.append((pid, self.workers.pop(pid), os.waitstatus_to_exitcode(status)))
+            self.draining.pop(pid, None)
+        return died
+
+    #Kills workers that have taken too long to drain
+    def kill_late(self):
+        for pid, since in list(self.draining.items()):
+            if time.monotonic() - since > self.args.graceful_timeout:
+                logger.warning("Worker %d didn't stop in %d seconds, killing it", pid, self.args.graceful_timeout)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.draining[pid] = float("inf") #Doesn't kill it again
+
+    #Starts the workers and looks after them until the master is stopped
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        for _ in range(self.args.workers):
+            os.close(self.spawn()) #Doesn't wait for them, connections queue on the socket until they are
+        logger.info("Master %d started %d workers on http://%s:%d", os.getpid(), self.args.workers, self.args.host, self.args.port)
+
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP: #Starts new workers then drains the old ones once they are ready
+                    logger.info("Reloading")
+                    old = list(self.workers)
+                    pipes = [self.spawn() for _ in range(self.args.workers)]
+                    new = [pid for pid in self.workers if pid not in old]
+                    if self.wait_ready(pipes):
+                        for pid in old:
+                            self.drain(pid)
+                    else: #Keeps the old workers serving so a broken deploy isn't an outage
+                        logger.error("New workers failed to start, keeping the old ones")
+                        for pid in new:
+                            self.drain(pid)
+                else: #Drains every worker and stops
+                    return self.stop()
+
+            for pid, started, code in self.reap(): #Replaces workers that died
+                logger.warning("Worker %d exited with code %d, starting another", pid, code)
+                if time.monotonic() - started < 1: #If it died straight after starting
+                    time.sleep(1)
+                os.close(self.spawn())
+            self.kill_late()
+            time.sleep(0.1)
+
+    #Drains every worker and waits for them to exit
+    def stop(self):
+        logger.info("Stopping, waiting up to %d seconds for requests to finish", self.args.graceful_timeout)
+        for pid in list(self.workers):
+            self.drain(pid)
+        while self.draining:
+            self.reap()
+            self.kill_late()
+            time.sleep(0.1)
+        self.listener.close()
+        logger.info("Stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs the app with several worker processes")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 2000)
+    parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "number of worker processes")
+    parser.add_argument("--app", default = "app:app", help = "WSGI app to serve as module:name")
+    parser.add_argument("--graceful-timeout", type = int, default = 30, help = "seconds a worker has to finish its requests")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s [%(process)d] %(message)s")
+
+    #Opens the socket in the master so every worker accepts connections from it
+    listener = socket.create_server((args.host, args.port), backlog = 2048)
+    listener.set_inheritable(True)
+    if args.workers > 1: #Each worker has its own cache, so cached views are checked against the database
+        os.environ.setdefault("CACHE_REVALIDATE", "1")
+    Master(args, listener).run()
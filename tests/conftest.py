@@ -0,0 +1,39 @@
+'''
+Fixtures shared by the tests. The app is pointed at an in-memory mongomock collection so the
+tests run without a database server, and each test gets an empty collection and response cache.
+Tests that need mongod's own update behaviour use a real server and are skipped without one.
+'''
+
+#Imports the modules to find the app, fake the database and patch the app's globals
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mongomock, pymongo, pytest
+import app as flask_app, config
+from cache import ResponseCache
+
+#Empty in-memory businesses collection
+@pytest.fixture
+def businesses():
+    return mongomock.MongoClient().testDB.biz
+
+#Test client for the Flask app using the in-memory collection and an empty cache
+@pytest.fixture
+def client(businesses, monkeypatch):
+    monkeypatch.setattr(flask_app, "businesses", businesses)
+    monkeypatch.setattr(flask_app, "response_cache", ResponseCache(100, 60))
+    return flask_app.app.test_client()
+
+#Empty businesses collection on a real mongod at MONGO_URI, the test is skipped if there isn't one
+@pytest.fixture
+def mongod_businesses():
+    client = pymongo.MongoClient(config.MONGO_URI, serverSelectionTimeoutMS = 500)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("No mongod at " + config.MONGO_URI)
+    collection = client["dizTest"]["biz"]
+    collection.drop()
+    yield collection
+    collection.drop()
+    client.close()
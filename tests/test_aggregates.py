@@ -0,0 +1,55 @@
+'''
+Tests for the review update pipelines in aggregates.py. Each one sets the reviews and the
+aggregates in one $set that must read the document as it was before the update, which mongomock
+doesn't do, so these run against a real mongod and are skipped without one.
+'''
+
+#Imports the updates under test and the modules to build documents
+from aggregates import BACKFILL_UPDATE, add_reviews_update, edit_review_update, delete_review_update
+from common import new_business_document, new_review_document
+
+#Adds a business with no reviews and returns its ID
+def add_business(businesses):
+    business = new_business_document("Biz", "Belfast", 3)
+    businesses.insert_one(business)
+    return business["_id"]
+
+#Returns the review count, star sum, average and version of a business
+def aggregates(businesses, id):
+    business = businesses.find_one({"_id" : id})
+    return business["review_count"], business["star_sum"], business["avg_stars"], business["version"]
+
+def test_add_reviews_updates_the_aggregates(mongod_businesses):
+    id = add_business(mongod_businesses)
+    mongod_businesses.update_one({"_id" : id}, add_reviews_update([new_review_document("a", "c", 4)]))
+    mongod_businesses.update_one({"_id" : id}, add_reviews_update([new_review_document("b", "c", 2), new_review_document("c", "c", 3)]))
+    assert aggregates(mongod_businesses, id) == (3, 9, 3, 2)
+
+def test_edit_review_replaces_its_stars(mongod_businesses):
+    id = add_business(mongod_businesses)
+    reviews = [new_review_document("a", "c", 4), new_review_document("b", "c", 2)]
+    mongod_businesses.update_one({"_id" : id}, add_reviews_update(reviews))
+    result = mongod_businesses.update_one({"_id" : id, "reviews._id" : reviews[1]["_id"]},
+                                          edit_review_update(reviews[1]["_id"], {"username" : "b", "comment" : "d", "stars" : 5}))
+    assert result.matched_count == 1
+    assert aggregates(mongod_businesses, id) == (2, 9, 4.5, 2)
+    assert mongod_businesses.find_one({"_id" : id})["reviews"][1]["comment"] == "d"
+
+def test_delete_review_removes_its_stars(mongod_businesses):
+    id = add_business(mongod_businesses)
+    reviews = [new_review_document("a", "c", 4), new_review_document("b", "c", 2)]
+    mongod_businesses.update_one({"_id" : id}, add_reviews_update(reviews))
+    mongod_businesses.update_one({"_id" : id, "reviews._id" : reviews[0]["_id"]}, delete_review_update(reviews[0]["_id"]))
+    assert aggregates(mongod_businesses, id) == (1, 2, 2, 2)
+    mongod_businesses.update_one({"_id" : id, "reviews._id" : reviews[1]["_id"]}, delete_review_update(reviews[1]["_id"]))
+    assert aggregates(mongod_businesses, id) == (0, 0, None, 3) #No reviews gives no average
+
+def test_backfill_converts_strings_and_changes_the_version(mongod_businesses):
+    mongod_businesses.insert_one({"name" : "Old", "town" : "Derry", "rating" : "4", "version" : 1,
+                                  "reviews" : [{"username" : "a", "comment" : "c", "stars" : "5"},
+                                               {"username" : "b", "comment" : "c", "stars" : "2"}]})
+    mongod_businesses.update_many({}, BACKFILL_UPDATE)
+    business = mongod_businesses.find_one()
+    assert business["rating"] == 4 and [review["stars"] for review in business["reviews"]] == [5, 2]
+    assert (business["review_count"], business["star_sum"], business["avg_stars"]) == (2, 7, 3.5)
+    assert business["version"] == 2 #ETags for the string typed data no longer match
@@ -0,0 +1,203 @@
+'''
+Tests for the asyncio app in async_app.py. The ASGI app is called directly with a scope and
+messages, as an ASGI server would, and is pointed at the in-memory mongomock collection through
+a thin wrapper that makes its methods awaitable like AsyncMongoClient's.
+'''
+
+#Imports the app under test and the modules to build documents and run the event loop
+from bson import ObjectId
+from pymongo.errors import ServerSelectionTimeoutError
+from cache import ResponseCache
+from common import QueryPlans, new_business_document, new_review_document
+import async_app, asyncio, json, pytest
+
+#Async cursor over a mongomock cursor
+class AsyncCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args):
+        self.cursor = self.cursor.sort(*args)
+        return self
+
+    def skip(self, count):
+        self.cursor = self.cursor.skip(count)
+        return self
+
+    def limit(self, count):
+        self.cursor = self.cursor.limit(count)
+        return self
+
+    def hint(self, index):
+        return self
+
+    async def to_list(self, length = None):
+        return list(self.cursor)
+
+    async def __aiter__(self):
+        for document in self.cursor:
+            yield document
+
+#Database whose explain command returns a plan that uses an index, as mongomock can't explain
+class AsyncDatabase:
+    async def command(self, command):
+        return {"queryPlanner" : {"winningPlan" : {"stage" : "FETCH", "inputStage" : {"stage" : "IXSCAN", "indexBounds" : {}}}}}
+
+#Collection with awaitable methods over a mongomock collection
+class AsyncCollection:
+    def __init__(self, collection):
+        self.collection, self.name, self.database = collection, collection.name, AsyncDatabase()
+
+    def find(self, *args):
+        return AsyncCursor(self.collection.find(*args))
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+#Client whose ping succeeds unless 'error' is set
+class AsyncClient:
+    def __init__(self):
+        self.error = None
+        self.admin = self
+
+    async def command(self, name):
+        if self.error:
+            raise self.error
+        return {"ok" : 1}
+
+    async def close(self):
+        pass
+
+#The asyncio app using the in-memory collection, an empty cache and no checked query plans
+@pytest.fixture
+def client(businesses, monkeypatch):
+    fake = AsyncClient()
+    monkeypatch.setattr(async_app, "client", fake)
+    monkeypatch.setattr(async_app, "businesses", AsyncCollection(businesses))
+    monkeypatch.setattr(async_app, "response_cache", ResponseCache(100, 60))
+    monkeypatch.setattr(async_app, "query_plans", QueryPlans())
+    monkeypatch.setattr(async_app, "draining", False)
+    return fake
+
+#Sends a request to the app, returns the status, headers and body
+def call(method, path, query = "", body = b"", headers = None):
+    scope = {"type" : "http", "method" : method, "path" : path, "query_string" : query.encode(),
+             "headers" : [(name.encode(), value.encode()) for name, value in (headers or {}).items()]}
+    messages, sent = [{"type" : "http.request", "body" : body}], []
+    async def receive():
+        return messages.pop(0)
+    async def send(message):
+        sent.append(message)
+    asyncio.run(async_app.app(scope, receive, send))
+    headers = {name.decode() : value.decode() for name, value in sent[0]["headers"]}
+    return sent[0]["status"], headers, b"".join(message.get("body", b"") for message in sent[1:])
+
+#Sends a request and reads the JSON body
+def call_json(*args, **kwargs):
+    status, headers, body = call(*args, **kwargs)
+    return status, headers, json.loads(body) if body else None
+
+#Adds businesses named A, B, C... with one review each, returns their IDs in order
+def add_businesses(businesses, count):
+    ids = []
+    for number in range(count):
+        business = new_business_document(chr(ord("A") + number), "Belfast" if number % 2 else "Derry", number % 5 + 1)
+        business["reviews"] = [new_review_document("user", "Fine", number % 5 + 1)]
+        business.update(review_count = 1, star_sum = number % 5 + 1, avg_stars = number % 5 + 1)
+        businesses.insert_one(business)
+        ids.append(str(business["_id"]))
+    return ids
+
+def test_list_returns_a_page_with_server_timing(client, businesses):
+    add_businesses(businesses, 5)
+    status, headers, page = call_json("GET", "/api/v1.0/businesses", "ps=2&sort=name")
+    assert status == 200
+    assert [business["name"] for business in page] == ["A", "B"]
+    assert "db;dur=" in headers["server-timing"]
+
+def test_cursor_pages_cover_every_business(client, businesses):
+    add_businesses(businesses, 7)
+    names, token = [], ""
+    while True:
+        status, _, page = call_json("GET", "/api/v1.0/businesses", "ps=3&sort=-name&after=" + token)
+        assert status == 200
+        names += [business["name"] for business in page["businesses"]]
+        if not page["next"]:
+            break
+        token = page["next"]
+    assert names == ["G", "F", "E", "D", "C", "B", "A"]
+
+def test_forged_cursor_is_rejected(client, businesses):
+    add_businesses(businesses, 2)
+    status, _, body = call_json("GET", "/api/v1.0/businesses", "ps=2&after=not-a-token")
+    assert status == 400 and "error" in body
+
+def test_top_businesses_are_best_first(client, businesses):
+    add_businesses(businesses, 5)
+    status, _, top = call_json("GET", "/api/v1.0/businesses/top", "n=2")
+    assert status == 200
+    assert [business["avg_stars"] for business in top] == [5, 4]
+
+def test_batch_read_keeps_the_order_of_the_ids(client, businesses):
+    ids = add_businesses(businesses, 3)
+    missing = str(ObjectId())
+    status, _, found = call_json("GET", "/api/v1.0/businesses", "ids=" + ",".join([ids[2], missing, ids[0].upper()]))
+    assert status == 200
+    assert [business and business["name"] for business in found] == ["C", None, "A"]
+
+def test_unchanged_business_gets_a_304(client, businesses):
+    id = add_businesses(businesses, 1)[0]
+    status, headers, body = call("GET", "/api/v1.0/businesses/" + id)
+    assert status == 200 and json.loads(body)["name"] == "A"
+    status, _, body = call("GET", "/api/v1.0/businesses/" + id.upper(), headers = {"if-none-match" : headers["etag"]})
+    assert status == 304 and body == b""
+
+def test_batch_add_reports_each_item(client, businesses):
+    items = [{"name" : "New", "town" : "Newry", "rating" : 4}, {"name" : "No town"}]
+    status, _, body = call_json("POST", "/api/v1.0/businesses:batch", body = json.dumps(items).encode(),
+                                headers = {"content-type" : "application/json"})
+    assert status == 207
+    assert [result["status"] for result in body["results"]] == [201, 400]
+    assert businesses.count_documents({"name" : "New"}) == 1
+
+def test_edit_review_without_every_field_is_a_json_error(client, businesses):
+    id = add_businesses(businesses, 1)[0]
+    rid = str(businesses.find_one()["reviews"][0]["_id"])
+    status, _, body = call_json("PUT", "/api/v1.0/businesses/%s/reviews/%s" % (id, rid), body = b"stars=4",
+                                headers = {"content-type" : "application/x-www-form-urlencoded"})
+    assert status == 400 and body == {"error" : "Missing form data"}
+
+@pytest.mark.parametrize("method, path, expected", [
+    ("GET", "/nowhere", 404), ("PATCH", "/api/v1.0/businesses", 405), ("GET", "/api/v1.0/businesses/" + str(ObjectId()), 404)])
+def test_unknown_routes_and_businesses(client, method, path, expected):
+    status, _, body = call_json(method, path)
+    assert status == expected and "error" in body
+
+def test_metrics_count_requests_by_route(client, businesses):
+    add_businesses(businesses, 1)
+    call("GET", "/api/v1.0/businesses")
+    status, headers, body = call("GET", "/metrics")
+    assert status == 200 and headers["content-type"].startswith("text/plain")
+    assert 'http_request_duration_seconds_count{route="/api/v1.0/businesses",method="GET",status="200"}' in body.decode()
+
+def test_health_checks(client):
+    assert call_json("GET", "/healthz")[0] == 200
+    status, _, body = call_json("GET", "/readyz")
+    assert status == 200 and body["status"] == "ready"
+    client.error = ServerSelectionTimeoutError("no servers")
+    status, _, body = call_json("GET", "/readyz")
+    assert status == 503 and body["status"] == "unavailable"
+
+def test_not_ready_once_shutdown_starts(client):
+    messages, sent = [{"type" : "lifespan.shutdown"}], []
+    async def receive():
+        return messages.pop(0)
+    async def send(message):
+        sent.append(message)
+    asyncio.run(async_app.app({"type" : "lifespan"}, receive, send))
+    assert sent == [{"type" : "lifespan.shutdown.complete"}]
+    status, _, body = call_json("GET", "/readyz")
+    assert status == 503 and body["status"] == "draining"
@@ -0,0 +1,129 @@
+'''
+Tests for the response cache in cache.py and how the app uses it.
+'''
+
+#Imports the modules to build documents and the cache under test
+from bson import ObjectId
+from cache import ResponseCache
+from common import MAX_REVIEW_OFFSET, new_business_document, new_review_document
+import app as flask_app
+import config
+
+#Adds a business with some reviews and returns its ID
+def add_business(businesses, reviews = 0):
+    business = new_business_document("Biz", "Belfast", 3)
+    business["reviews"] = [new_review_document("user", "Fine", 3) for _ in range(reviews)]
+    businesses.insert_one(business)
+    return str(business["_id"])
+
+def test_views_are_bounded_not_businesses():
+    cache = ResponseCache(100, 60)
+    for offset in range(3000): #Many views of one business
+        cache.put("a", "reviews?offset=%d" % offset, b"[]", cache.epoch)
+    stats = cache.stats()
+    assert stats["entries"] == 100
+    assert stats["businesses"] == 1
+    assert stats["evictions"] == 2900
+
+def test_least_recently_used_view_is_evicted():
+    cache = ResponseCache(2, 60)
+    cache.put("a", "one", b"1", cache.epoch)
+    cache.put("a", "two", b"2", cache.epoch)
+    cache.get("a", "one") #Makes 'two' the least recently used
+    cache.put("b", "one", b"3", cache.epoch)
+    assert cache.get("a", "one") == b"1"
+    assert cache.get("a", "two") is None
+    assert cache.get("b", "one") == b"3"
+
+def test_views_are_bounded_by_bytes():
+    cache = ResponseCache(100, 60, max_bytes = 10)
+    for number in range(5):
+        cache.put("a", str(number), b"1234", cache.epoch, 4)
+    assert cache.stats()["entries"] == 2
+    assert cache.size == 8
+
+def test_expired_view_is_removed_when_found():
+    cache = ResponseCache(100, -1) #Every view has already expired
+    cache.put("a", "one", b"1", cache.epoch, 1)
+    assert cache.get("a", "one") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["businesses"] == 0
+    assert cache.size == 0
+
+def test_invalidate_removes_every_view_of_a_business():
+    cache = ResponseCache(100, 60)
+    cache.put("a", "one", b"1", cache.epoch)
+    cache.put("a", "two", b"2", cache.epoch)
+    cache.put("b", "one", b"3", cache.epoch)
+    cache.invalidate("a")
+    assert cache.get("a", "one") is None and cache.get("a", "two") is None
+    assert cache.get("b", "one") == b"3"
+    assert cache.stats()["invalidations"] == 1
+
+def test_load_that_raced_a_write_is_not_stored():
+    cache = ResponseCache(100, 60)
+    epoch = cache.epoch #Noted before the load
+    cache.invalidate("a") #A write happens during the load
+    cache.put("a", "one", b"old", epoch)
+    assert cache.get("a", "one") is None
+
+def test_uppercase_id_shares_cache_entry_with_writes(client, businesses):
+    id = add_business(businesses)
+    assert client.get("/api/v1.0/businesses/" + id.upper()).get_json()["name"] == "Biz"
+    response = client.put("/api/v1.0/businesses/" + id, data = {"name" : "New name", "town" : "Derry", "rating" : 4})
+    assert response.status_code == 200
+    assert client.get("/api/v1.0/businesses/" + id.upper()).get_json()["name"] == "New name"
+
+def test_etag_is_the_same_for_any_case(client, businesses):
+    id = add_business(businesses)
+    etag = client.get("/api/v1.0/businesses/" + id).headers["ETag"]
+    response = client.get("/api/v1.0/businesses/" + id.upper(), headers = {"If-None-Match" : etag})
+    assert response.status_code == 304
+
+def test_new_review_invalidates_cached_pages(client, businesses):
+    id = add_business(businesses, reviews = 2)
+    assert len(client.get("/api/v1.0/businesses/%s/reviews" % id).get_json()) == 2
+    response = client.post("/api/v1.0/businesses/%s/reviews" % id.upper(), data = {"username" : "u", "comment" : "c", "stars" : 5})
+    assert response.status_code == 201
+    assert len(client.get("/api/v1.0/businesses/%s/reviews" % id).get_json()) == 3
+
+def test_review_offset_is_capped(client, businesses):
+    id = add_business(businesses)
+    response = client.get("/api/v1.0/businesses/%s/reviews?offset=%d" % (id, MAX_REVIEW_OFFSET + 1))
+    assert response.status_code == 400
+    assert flask_app.response_cache.stats()["entries"] == 0
+
+def test_missing_business_is_not_cached(client):
+    response = client.get("/api/v1.0/businesses/" + str(ObjectId()))
+    assert response.status_code == 404
+    assert flask_app.response_cache.stats()["entries"] == 0
+
+def test_edit_review_without_every_field_is_a_json_error(client, businesses):
+    id = add_business(businesses, reviews = 1)
+    rid = str(businesses.find_one()["reviews"][0]["_id"])
+    response = client.put("/api/v1.0/businesses/%s/reviews/%s" % (id, rid), data = {"stars" : 4})
+    assert response.status_code == 400
+    assert response.get_json() == {"error" : "Missing form data"}
+
+def test_cached_view_changed_by_another_worker_is_reloaded(client, businesses, monkeypatch):
+    monkeypatch.setattr(config, "CACHE_REVALIDATE", True) #As serve.py does with several workers
+    id = add_business(businesses)
+    etag = client.get("/api/v1.0/businesses/" + id).headers["ETag"]
+    #Another worker's write, which this process's cache doesn't see
+    businesses.update_one({"_id" : ObjectId(id)}, {"$set" : {"name" : "New name"}, "$inc" : {"version" : 1}})
+    response = client.get("/api/v1.0/businesses/" + id, headers = {"If-None-Match" : etag})
+    assert response.status_code == 200
+    assert response.get_json()["name"] == "New name"
+
+def test_cached_view_of_a_business_deleted_by_another_worker_is_gone(client, businesses, monkeypatch):
+    monkeypatch.setattr(config, "CACHE_REVALIDATE", True) #As serve.py does with several workers
+    id = add_business(businesses)
+    assert client.get("/api/v1.0/businesses/" + id).status_code == 200
+    businesses.delete_one({"_id" : ObjectId(id)})
+    assert client.get("/api/v1.0/businesses/" + id).status_code == 404
+
+def test_cached_304_needs_no_database_round_trip_by_default(client, businesses, monkeypatch):
+    id = add_business(businesses)
+    etag = client.get("/api/v1.0/businesses/" + id).headers["ETag"]
+    monkeypatch.setattr(flask_app, "businesses", None) #Any database access would fail
+    assert client.get("/api/v1.0/businesses/" + id, headers = {"If-None-Match" : etag}).status_code == 304
@@ -0,0 +1,139 @@
+'''
+Tests for the cursor tokens, seek filters, query plan checks and batch builders in common.py.
+'''
+
+#Imports the functions under test and the modules to build test data
+from bson import ObjectId
+from common import (encode_cursor, decode_cursor, seek_after, reads_every_document, business_batch, review_batch,
+                    mark_failed_writes, business_url, review_url, get_list_options, plan_key, explain_command, QueryPlans)
+import base64, json, pytest
+
+def test_id_cursor_round_trip():
+    id = ObjectId()
+    token = encode_cursor(("_id", 1), {"_id" : id})
+    assert decode_cursor(token, ("_id", 1)) == (None, id)
+
+def test_field_cursor_round_trip():
+    id = ObjectId()
+    token = encode_cursor(("rating", -1), {"_id" : id, "rating" : 4})
+    assert "=" not in token #The padding is removed so the token is URL friendly
+    assert decode_cursor(token, ("rating", -1)) == (4, id)
+
+def test_cursor_for_another_sort_is_rejected():
+    token = encode_cursor(("rating", 1), {"_id" : ObjectId(), "rating" : 4})
+    assert decode_cursor(token, ("rating", -1)) is None
+    assert decode_cursor(token, ("name", 1)) is None
+
+@pytest.mark.parametrize("token", ["not a token", "e30", "eyJzIjoiX2lkIiwiZCI6MSwiaWQiOiJ4In0"])
+def test_invalid_cursor_is_rejected(token):
+    assert decode_cursor(token, ("_id", 1)) is None
+    assert seek_after({}, token, ("_id", 1)) is None
+
+#Builds a token holding any position, as a client could
+def forged_token(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+@pytest.mark.parametrize("value", [{"$ne" : None}, ["a"], True, 10 ** 30, "Derry"])
+def test_cursor_with_a_forged_sort_value_is_rejected(value):
+    token = forged_token({"s" : "rating", "d" : 1, "id" : str(ObjectId()), "v" : value})
+    assert decode_cursor(token, ("rating", 1)) is None
+    assert seek_after({}, token, ("rating", 1)) is None
+
+def test_cursor_with_deeply_nested_json_is_rejected():
+    token = base64.urlsafe_b64encode(b"[" * 100000 + b"]" * 100000).decode()
+    assert decode_cursor(token, ("name", 1)) is None
+
+def test_cursor_sort_value_can_be_missing():
+    id = ObjectId()
+    token = encode_cursor(("name", 1), {"_id" : id}) #A business without a name
+    assert decode_cursor(token, ("name", 1)) == (None, id)
+
+@pytest.mark.parametrize("args", [{"pn" : str(10 ** 20)}, {"pn" : "0"}, {"min_rating" : str(10 ** 20)},
+                                  {"max_rating" : "-" + str(10 ** 20)}, {"min_rating" : "6"}])
+def test_list_options_out_of_range_are_rejected(args):
+    error, options = get_list_options(args)
+    assert error is not None and options is None
+
+def test_empty_cursor_starts_from_the_first_page():
+    assert seek_after({"town" : "Derry"}, "", ("_id", 1)) == {"town" : "Derry"}
+
+@pytest.mark.parametrize("sort", [("_id", 1), ("_id", -1), ("rating", 1), ("rating", -1)])
+def test_pages_cover_every_business_once(businesses, sort):
+    #Adds businesses with many tied ratings so pages have to be split inside a tie
+    businesses.insert_many([{"_id" : ObjectId(), "rating" : number % 3, "town" : "Derry" if number % 2 else "Newry"}
+                            for number in range(50)])
+    field, direction = sort
+    sort_order = [sort] if field == "_id" else [sort, ("_id", direction)]
+    query = {"town" : "Derry"}
+    expected = [business["_id"] for business in businesses.find(query).sort(sort_order)]
+
+    #Reads the pages with the seek filter, as the list route does
+    seen, token = [], ""
+    while True:
+        page = list(businesses.find(seek_after(query, token, sort)).sort(sort_order).limit(7))
+        seen.extend(business["_id"] for business in page)
+        if len(page) < 7:
+            break
+        token = encode_cursor(sort, page[-1])
+    assert seen == expected
+
+#Plans in the form returned by explain()
+COLLSCAN_PLAN = {"stage" : "COLLSCAN", "filter" : {"rating" : {"$gte" : 1}}, "direction" : "forward"}
+WHOLE_INDEX_PLAN = {"stage" : "FETCH", "filter" : {"rating" : {"$gte" : 1}}, "inputStage" : {
+    "stage" : "IXSCAN", "indexName" : "name", "indexBounds" : {"name" : ["[MinKey, MaxKey]"], "_id" : ["[MinKey, MaxKey]"]}}}
+REVERSE_WHOLE_INDEX_PLAN = {"stage" : "FETCH", "inputStage" : {
+    "stage" : "IXSCAN", "indexName" : "name", "indexBounds" : {"name" : ["[MaxKey, MinKey]"], "_id" : ["[MaxKey, MinKey]"]}}}
+BOUNDED_PLAN = {"stage" : "FETCH", "inputStage" : {
+    "stage" : "IXSCAN", "indexName" : "town_name", "indexBounds" : {
+        "town" : ['["Derry", "Derry"]'], "name" : ["[MinKey, MaxKey]"], "_id" : ["[MinKey, MaxKey]"]}}}
+
+def test_collection_scan_reads_every_document():
+    assert reads_every_document(COLLSCAN_PLAN, {})
+    assert reads_every_document(COLLSCAN_PLAN, {"rating" : {"$gte" : 1}})
+
+def test_whole_index_scan_under_a_filter_reads_every_document():
+    assert reads_every_document(WHOLE_INDEX_PLAN, {"rating" : {"$gte" : 1}})
+    assert reads_every_document(REVERSE_WHOLE_INDEX_PLAN, {"rating" : {"$gte" : 1}})
+
+def test_whole_index_scan_for_the_sort_order_alone_is_allowed():
+    assert not reads_every_document(REVERSE_WHOLE_INDEX_PLAN, {})
+
+def test_bounded_index_scan_is_allowed():
+    assert not reads_every_document(BOUNDED_PLAN, {"town" : "Derry"})
+
+def test_business_batch_results_follow_the_items():
+    results, operations, positions = business_batch([{"name" : "A", "town" : "Derry", "rating" : 3}, {"name" : "B"},
+                                                     {"name" : "C", "town" : "Newry", "rating" : 5}])
+    assert [result["status"] for result in results] == [201, 400, 201]
+    assert positions == [0, 2] and len(operations) == 2
+    assert results[0]["url"] == business_url(operations[0]._doc["_id"])
+
+    #A failed insert replaces the result of its item
+    mark_failed_writes(results, positions, {"writeErrors" : [{"index" : 1, "errmsg" : "duplicate key"}]})
+    assert results[2] == {"index" : 2, "status" : 500, "error" : "duplicate key"}
+    assert results[0]["status"] == 201
+
+def test_review_batch_urls_use_the_business_id():
+    id = str(ObjectId())
+    results, new_reviews = review_batch(id, [{"username" : "u", "comment" : "c", "stars" : 4}, {"username" : "u"}])
+    assert [result["status"] for result in results] == [201, 400]
+    assert results[0]["url"] == review_url(id, new_reviews[0]["_id"])
+
+def test_plan_key_ignores_values_and_operators_from_the_client():
+    sort_order = [("rating", 1), ("_id", 1)]
+    keys = {plan_key(seek_after({"town" : "Derry"}, encode_cursor(("rating", 1), {"_id" : ObjectId(), "rating" : rating}),
+                                ("rating", 1)), sort_order) for rating in range(1, 6)}
+    keys.add(plan_key({"town" : "Derry", "rating" : {"$gte" : 1}, "_id" : 1}, sort_order))
+    assert len(keys) == 1
+
+def test_query_plans_keep_a_bounded_number_of_shapes():
+    plans = QueryPlans(max_shapes = 2)
+    for shape in ("a", "b", "c"):
+        assert plans.allows(shape) is None
+        assert plans.check(shape, BOUNDED_PLAN, {"town" : "Derry"})
+    assert len(plans.allowed) == 2 and plans.allows("a") is None #The oldest shape was dropped
+
+def test_explain_only_asks_for_the_plan():
+    command = explain_command("biz", {"town" : "Derry"}, {"name" : 1}, [("name", 1), ("_id", 1)])
+    assert command["verbosity"] == "queryPlanner" #Other verbosities run the candidate plans
+    assert list(command["explain"]["sort"]) == ["name", "_id"]
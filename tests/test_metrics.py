@@ -0,0 +1,38 @@
+'''
+Tests for the request metrics in metrics.py and how the app records them.
+'''
+
+#Imports the modules to fake database work and read the metrics
+from metrics import reply_documents
+import app as flask_app
+
+def test_reply_documents_counts_cursor_batches():
+    assert reply_documents({"cursor" : {"firstBatch" : [{}, {}], "id" : 0}, "ok" : 1}) == 2
+    assert reply_documents({"cursor" : {"nextBatch" : [{}], "id" : 0}, "ok" : 1}) == 1
+    assert reply_documents({"value" : {"_id" : 1}, "ok" : 1}) == 1
+    assert reply_documents({"n" : 1, "ok" : 1}) == 0
+
+#Returns the value of a counter for the list route
+def list_route_count(counter):
+    return counter.values.get(("/api/v1.0/businesses", "GET"), 0)
+
+def test_streamed_list_database_work_is_timed(client, monkeypatch):
+    #Stands in for a cursor whose database commands run as it is read, like a pymongo cursor
+    def find_businesses(query, projection, sort_order):
+        class Cursor:
+            def skip(self, count): return self
+            def limit(self, count): return self
+            def __iter__(self):
+                for number in range(3):
+                    flask_app.command_timer.add(1, 1, 0.001) #A command returning one document
+                    yield {"_id" : number}
+        return Cursor()
+    monkeypatch.setattr(flask_app, "find_businesses", find_businesses)
+
+    before = list_route_count(flask_app.request_metrics.commands), list_route_count(flask_app.request_metrics.documents)
+    response = client.get("/api/v1.0/businesses")
+    assert response.get_json() == [{"_id" : 0}, {"_id" : 1}, {"_id" : 2}]
+    response.close()
+    assert '3 commands, 3 documents' in response.headers["Server-Timing"] #The query ran before the headers
+    assert list_route_count(flask_app.request_metrics.commands) - before[0] == 3
+    assert list_route_count(flask_app.request_metrics.documents) - before[1] == 3
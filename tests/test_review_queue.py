@@ -0,0 +1,92 @@
+'''
+Tests for the write-behind review queue in review_queue.py. The queue's bulk writes go to a fake
+collection that records them, since mongomock can't run pipeline updates in a bulk_write.
+'''
+
+#Imports the queue under test and the modules to build reviews and fake write results
+from pymongo.errors import AutoReconnect, BulkWriteError
+from bson import ObjectId
+from common import new_review_document
+from review_queue import ReviewQueue
+import app as flask_app
+import pytest
+
+#Collection that records each bulk_write and raises 'error' for the first 'failures' of them
+class FakeCollection:
+    def __init__(self, failures = 0, error = AutoReconnect("connection closed")):
+        self.failures, self.error = failures, error
+        self.writes = []
+
+    def bulk_write(self, operations, ordered = True):
+        self.writes.append(operations)
+        if len(self.writes) <= self.failures:
+            raise self.error
+        return type("Result", (), {"matched_count" : len(operations)})()
+
+#Queue writing to 'collection' that records the businesses it was told were written
+def make_queue(collection, written):
+    return ReviewQueue(lambda: collection, 100, 60, on_written = written.append)
+
+def test_failed_write_is_retried_and_cannot_add_reviews_twice():
+    collection = FakeCollection(failures = 1)
+    queue = ReviewQueue(lambda: collection, 100, 60)
+    id = str(ObjectId())
+    review = new_review_document("u", "c", 4)
+    queue.add(id, review)
+    queue.flush() #Fails and queues the review again
+    assert queue.size == 1 and queue.retried.values[()] == 1
+
+    queue.flush()
+    assert queue.size == 0 and queue.written.values[()] == 1
+    #Both writes only match a business without the review, so one that was applied can't be repeated
+    for operations in collection.writes:
+        assert operations[0]._filter == {"_id" : ObjectId(id), "reviews._id" : {"$ne" : review["_id"]}}
+
+def test_reviews_are_dropped_after_the_last_attempt():
+    collection = FakeCollection(failures = 2)
+    queue = ReviewQueue(lambda: collection, 100, 60, max_attempts = 2)
+    queue.add(str(ObjectId()), new_review_document("u", "c", 4))
+    queue.flush()
+    queue.flush()
+    assert queue.size == 0 and queue.dropped.values[()] == 1
+    queue.flush() #Nothing is left to write
+    assert len(collection.writes) == 2
+
+def test_write_concern_failure_is_retried():
+    error = BulkWriteError({"writeErrors" : [], "writeConcernErrors" : [{"code" : 64, "errmsg" : "waiting for replication timed out"}],
+                            "nMatched" : 1})
+    written = []
+    queue = make_queue(FakeCollection(failures = 1, error = error), written)
+    id = str(ObjectId())
+    queue.add(id, new_review_document("u", "c", 4))
+    queue.flush()
+    assert queue.size == 1 and queue.retried.values[()] == 1
+    assert written == [id] #The write may have been applied, so the cache is still invalidated
+    queue.flush()
+    assert queue.size == 0 and queue.written.values[()] == 1
+
+def test_rejected_update_is_dropped_and_the_rest_are_written():
+    error = BulkWriteError({"writeErrors" : [{"index" : 0, "errmsg" : "document too large"}], "nMatched" : 1})
+    queue = make_queue(FakeCollection(failures = 1, error = error), [])
+    queue.add(str(ObjectId()), new_review_document("u", "c", 4))
+    queue.add(str(ObjectId()), new_review_document("u", "c", 4))
+    queue.flush()
+    assert queue.size == 0 and queue.dropped.values[()] == 1 and queue.written.values[()] == 1
+
+def test_unexpected_error_still_queues_the_reviews_again():
+    written = []
+    queue = make_queue(FakeCollection(failures = 1, error = RuntimeError("bug")), written)
+    id = str(ObjectId())
+    queue.add(id, new_review_document("u", "c", 4))
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    assert queue.size == 1 and written == [id]
+    queue.stop() #Writes the review rather than raising
+    assert queue.size == 0 and queue.written.values[()] == 1
+
+def test_queued_review_for_a_missing_business_is_turned_away(client, monkeypatch):
+    queue = ReviewQueue(lambda: FakeCollection(), 100, 60)
+    monkeypatch.setattr(flask_app, "review_queue", queue)
+    response = client.post("/api/v1.0/businesses/%s/reviews" % ObjectId(), data = {"username" : "u", "comment" : "c", "stars" : 5})
+    assert response.status_code == 400
+    assert queue.size == 0